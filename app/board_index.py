@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+sys.path.append('../modeling')
+from rank_index import RankIndex
+
+# One leaderboard, its key (csv name between board type and _leaderboard), its display name, its
+# formatted rows, a map from athlete/segment id to row position and the RankIndex of its full
+# ranking (None if none was stored)
+Board = namedtuple('Board', ['key', 'name', 'rows', 'positions', 'rank_index'])
+
+# Field names of a board row in the json api, {} is the board type
+row_fields = ('rank', '{}_id', 'rating', 'average_speed')
+
+# Manifest Leaderboards.store writes once all of its boards are in place, and the extensions of
+# the board files it lists
+board_manifest = 'boards_manifest.json'
+board_extensions = ('.csv', '.npz')
+
+def get_np_board(app_data, csv_list):
+    '''
+    Function to create list of numpy arrays for each board
+    Input:  Directory the boards are in, List of csv file names where board info is
+    '''
+    return [pd.read_csv(os.path.join(app_data, file_name)).values for file_name in csv_list]
+
+def get_boards(np_boards):
+    '''
+    Function to format information in numpy array version of boards into a tuple
+    Input:  List of numpy arrays
+    Output: Tuple of tuples with items properly formatted for html page
+    '''
+    return tuple(tuple((int(row[0]), int(row[1]), round(float(row[2]), 3), round(float(row[3]), 3))
+                       for row in board) 
+                 for board in np_boards)
+
+def get_rank_index(app_data, board_type, key):
+    '''
+    Function to load the full ranking Leaderboards.store_rank_indexes stored for a board
+    Input:  Directory the boards are in, Board type, Board key
+    Output: RankIndex, None if there is none for the board
+    '''
+    path = os.path.join(app_data, '{}_{}_rank_index.npz'.format(board_type, key))
+    return RankIndex.load(path) if os.path.exists(path) else None
+
+def get_rank_rows(rank_index, start, stop):
+    '''
+    Function to format positions of a full ranking like the rows of get_boards
+    Input:  RankIndex, Zero based start and stop positions in the ranking
+    Output: List of row tuples, average speed None where the index has none
+    '''
+    speeds = rank_index.average_speeds
+    return [(position + 1, int(rank_index.ids[position]), 
+             round(float(rank_index.ratings[position]), 3),
+             None if speeds is None or np.isnan(speeds[position]) 
+             else round(float(speeds[position]), 3))
+            for position in range(start, min(stop, len(rank_index.ids)))]
+
+def get_board_names(csv_list, board_name):
+    '''
+    Function to turn list of csv file names into list of board names
+    '''
+    return [name.strip('leaderboard.csv').strip(board_name).replace('_', ' ').title() 
+            for name in csv_list]
+
+def get_board_keys(csv_list, board_name):
+    '''
+    Function to turn list of csv file names into list of board keys, e.g. total_rating
+    '''
+    return [name[len(board_name) + 1:-len('_leaderboard.csv')] for name in csv_list]
+
+def get_board_stamp(app_data):
+    '''
+    Function to stamp the current state of the leaderboard csvs in a directory
+    Input:  Directory the boards are in
+    Output: Tuple of (file name, size, modification time) for every board file, sorted by name
+    '''
+    stamp = []
+    for name in sorted(os.listdir(app_data)):
+        if name.endswith(board_extensions):
+            stat = os.stat(os.path.join(app_data, name))
+            stamp.append((name, stat.st_size, stat.st_mtime))
+    return tuple(stamp)
+
+def get_manifest_stamp(app_data):
+    '''
+    Function to read the stamp of the boards the last completed store wrote
+    Input:  Directory the boards are in
+    Output: Tuple of (file name, size, modification time) like get_board_stamp, None if no store
+            has written a manifest
+    '''
+    path = os.path.join(app_data, board_manifest)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return tuple(tuple(board) for board in json.load(f)['boards'])
+
+class BoardIndex(object):
+    '''
+    Immutable, memory-resident snapshot of every leaderboard csv in a directory, with each board
+    type's html page and json pre-rendered so serving one is a dictionary lookup
+    '''
+    # Board types, the prefix of their csv file names
+    board_types = ('athlete', 'segment')
+
+    def __init__(self, app_data, render_page):
+        '''
+        Input:  Directory the leaderboard csvs are in, 
+                Function taking a board type and its tuple of Boards, returning the html page
+        '''
+        # Stamp the directory first, a board rewritten while loading changes it for the watcher
+        self.stamp = get_board_stamp(app_data)
+        self.version = hashlib.md5(repr(self.stamp).encode('utf-8')).hexdigest()
+        self.last_modified = max([mtime for name, size, mtime in self.stamp] or [0])
+
+        csv_list = [name for name in os.listdir(app_data) if name.endswith('.csv')]
+
+        boards, pages, json_boards = {}, {}, {}
+        for board_type in self.board_types:
+            type_csv_list = [name for name in csv_list if board_type in name]
+            rows = get_boards(get_np_board(app_data, type_csv_list))
+            names = get_board_names(type_csv_list, board_type)
+            keys = get_board_keys(type_csv_list, board_type)
+
+            boards[board_type] = tuple(Board(key, name, board_rows, 
+                                             {row[1]: i for i, row in enumerate(board_rows)},
+                                             get_rank_index(app_data, board_type, key))
+                                       for key, name, board_rows in zip(keys, names, rows))
+            pages[board_type] = render_page(board_type, boards[board_type])
+            json_boards[board_type] = json.dumps(self.query(board_type, boards=boards))
+
+        self._boards = boards
+        self._pages = pages
+        self._json = json_boards
+
+    def boards(self, board_type):
+        '''
+        Input:  Board type, 'athlete' or 'segment'
+        Output: Tuple of Boards
+        '''
+        return self._boards[board_type]
+
+    def page(self, board_type):
+        '''
+        Input:  Board type, 'athlete' or 'segment'
+        Output: Pre-rendered html page of every board of that type
+        '''
+        return self._pages[board_type]
+
+    def json(self, board_type):
+        '''
+        Input:  Board type, 'athlete' or 'segment'
+        Output: Pre-rendered json of every whole board of that type, as returned by query
+        '''
+        return self._json[board_type]
+
+    def query(self, board_type, key=None, offset=0, limit=None, entity_id=None, around=None,
+              boards=None):
+        '''
+        Input:  Board type, 'athlete' or 'segment', Key of the one board to return, None for all,
+                Number of rows to skip, Maximum number of rows to return, None for the rest,
+                Athlete/segment id to return only the row of, Number of rows ranked on each side
+                of it to return as well, Boards to query, defaults to this index's
+        Output: Dictionary with a list of boards, each with its key, name, total number of rows,
+                number of athletes/segments in its full ranking and the selected rows as
+                dictionaries
+
+        Raises KeyError if there is no board with the key
+        '''
+        boards = (boards or self._boards)[board_type]
+        if key is not None:
+            boards = [board for board in boards if board.key == key]
+            if not boards:
+                raise KeyError(key)
+
+        fields = [field.format(board_type) for field in row_fields]
+        selected = []
+        for board in boards:
+            if entity_id is not None:
+                rows = self.get_entity_rows(board, entity_id, around or 0)
+            else:
+                rows = board.rows[offset:None if limit is None else offset + limit]
+            selected.append({'key': board.key, 
+                             'name': board.name.strip(),
+                             'total': len(board.rows),
+                             'ranked': len(board.rank_index.ids) if board.rank_index is not None
+                                       else len(board.rows),
+                             'rows': [dict(zip(fields, row)) for row in rows]})
+        return {'boards': selected}
+
+    def get_entity_rows(self, board, entity_id, width=0):
+        '''
+        Input:  Board, Athlete/segment id, Number of rows ranked on each side of it to return
+        Output: List of row tuples of the athlete/segment and its neighbours, empty if it is not
+                ranked
+
+        Looked up in the board's full RankIndex when it has one, so athletes/segments below the
+        board's top rows are found too
+        '''
+        if board.rank_index is None:
+            position = board.positions.get(entity_id)
+            if position is None:
+                return []
+            return list(board.rows[max(position - width, 0):position + width + 1])
+
+        position = board.rank_index.position(entity_id)
+        if position is None:
+            return []
+        return get_rank_rows(board.rank_index, max(position - width, 0), position + width + 1)
+
+class BoardWatcher(threading.Thread):
+    '''
+    Background thread that rebuilds the BoardIndex whenever the leaderboard csvs change and hands
+    the new index over whole, so readers never wait on or see a partly loaded index
+    '''
+    def __init__(self, app_data, render_page, board_index, on_update, interval=5):
+        '''
+        Input:  Directory the leaderboard csvs are in, Page rendering function for BoardIndex,
+                Index currently being served, Function called with each new BoardIndex,
+                Seconds between checks of the directory
+        '''
+        super(BoardWatcher, self).__init__()
+        self.daemon = True
+        self.app_data = app_data
+        self.render_page = render_page
+        self.stamp = board_index.stamp
+        self.on_update = on_update
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        '''
+        Function to rebuild and hand over the index if the csvs changed since the last build
+        Output: True if a new index was handed over
+        '''
+        stamp = get_board_stamp(self.app_data)
+        if stamp == self.stamp:
+            return False
+
+        # A store is still renaming its boards until its manifest matches them, check again later
+        manifest_stamp = get_manifest_stamp(self.app_data)
+        if manifest_stamp is not None and manifest_stamp != stamp:
+            return False
+
+        # Remember the stamp even if the build fails, a broken csv is retried once it is rewritten
+        self.stamp = stamp
+        try:
+            board_index = BoardIndex(self.app_data, self.render_page)
+        except Exception:
+            logging.exception('Failed to rebuild leaderboards from %s', self.app_data)
+            return False
+
+        # Only hand over an index whose csvs did not change while it was being built, otherwise
+        # the next check rebuilds it
+        if get_board_stamp(self.app_data) != board_index.stamp or board_index.stamp != stamp:
+            self.stamp = None
+            return False
+        self.on_update(board_index)
+        return True
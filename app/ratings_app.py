@@ -1,37 +1,37 @@
-import os
-import pandas as pd
-from flask import Flask, render_template
+from flask import Flask, Response, render_template, request, abort, jsonify
+from board_index import BoardIndex, BoardWatcher
 app = Flask(__name__)
 
-# Make leaderboard list from csvs
-app_data = './app_data/'
-csv_list = os.listdir(app_data)
-athlete_csv_list = [l for l in csv_list if 'athlete' in l]
-segment_csv_list = [l for l in csv_list if 'segment' in l]
+# Template, template argument and route for each board type's page
+board_pages = {'athlete': ('leaderboards.html', 'leaderboards_and_names', '/leaderboards'),
+               'segment': ('diffboards.html', 'diffboards_and_names', '/heinousboards')}
 
-def get_np_board(csv_list):
+def render_board_page(board_type, boards):
     '''
-    Function to create list of numpy arrays for each board
-    Input:  List of csv file names where board info is
+    Function to render the page for a board type once, outside of any request
+    Input:  Board type, tuple of Boards
+    Output: Html page
     '''
-    return [pd.read_csv(app_data + file_name).values for file_name in csv_list]
+    template, argument, path = board_pages[board_type]
+    with app.test_request_context(path):
+        return render_template(template, 
+                               **{argument: [(board.rows, board.name) for board in boards]})
 
-def get_boards(np_boards):
+def swap_board_index(new_board_index):
     '''
-    Function to format information in numpy array version of boards into a list
-    Input:  List of numpy arrays
-    Output: List of lists with items properly formatted for html page
+    Function to start serving a newly built index, rebinding the global is atomic so requests get
+    either the old index or the new one
     '''
-    return [[[int(row[0]), int(row[1]), round(float(row[2]), 3), round(float(row[3]), 3)] 
-              for row in board] 
-              for board in np_boards]
+    global board_index
+    board_index = new_board_index
 
-def get_board_names(csv_list, board_name):
-    '''
-    Function to turn list of csv file names into list of board names
-    '''
-    return [name.strip('leaderboard.csv').strip(board_name).replace('_', ' ').title() 
-            for name in csv_list]
+# Load every leaderboard csv once, requests are served straight from the index
+app_data = './app_data/'
+board_index = BoardIndex(app_data, render_board_page)
+
+# Rebuild the index in the background whenever new boards are stored
+board_watcher = BoardWatcher(app_data, render_board_page, board_index, swap_board_index)
+board_watcher.start()
 
 @app.route('/')
 def display_home():
@@ -43,27 +43,63 @@ def display_about():
 
 @app.route('/leaderboards')
 def display_leaderboards():
-    # Turn athlete csvs into dfs into nparray list
-    np_leaderboards = get_np_board(athlete_csv_list)
-
-    # Make list of leaderboard lists with correct data types
-    leaderboards = get_boards(np_leaderboards)
-    leaderboard_names = get_board_names(athlete_csv_list, 'athlete')
-
-    return render_template('leaderboards.html', 
-                            leaderboards_and_names=zip(leaderboards, leaderboard_names))
+    return board_index.page('athlete')
 
 @app.route('/heinousboards')
 def display_diffboards():
-    # Turn athlete csvs into dfs into nparray list
-    np_diffboards = get_np_board(segment_csv_list)
+    return board_index.page('segment')
+
+def get_int_arg(name):
+    '''
+    Function to read an optional integer query argument
+    Input:  Argument name
+    Output: Its integer value, None if it is not given
+
+    Raises ValueError if it is not an integer, request.args.get's type=int would quietly fall back
+    to the default instead
+    '''
+    value = request.args.get(name)
+    return None if value is None else int(value)
+
+def board_api_response(board_type):
+    '''
+    Function to answer a json board request from the current index, with ETag and Last-Modified
+    tied to the index version so clients can revalidate and get a 304
+    Input:  Board type, 'athlete' or 'segment'
+    Query:  board (board key, e.g. total_rating), offset, limit, athlete_id/segment_id, around
+            (rows ranked on each side of athlete_id/segment_id)
+    '''
+    current_index = board_index
+    try:
+        offset = get_int_arg('offset') or 0
+        limit = get_int_arg('limit')
+        entity_id = get_int_arg('{}_id'.format(board_type))
+        around = get_int_arg('around')
+        if offset < 0 or (limit is not None and limit < 0) or (around is not None and around < 0):
+            raise ValueError
+        key = request.args.get('board')
+        if key is None and not offset and limit is None and entity_id is None:
+            response = Response(current_index.json(board_type), mimetype='application/json')
+        else:
+            response = jsonify(current_index.query(board_type, key, offset, limit, entity_id,
+                                                   around))
+    except ValueError:
+        abort(400)
+    except KeyError:
+        abort(404)
+
+    response.set_etag(current_index.version)
+    response.last_modified = current_index.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-    # Make list of leaderboard lists with correct data types
-    diffboards = get_boards(np_diffboards)
-    diffboard_names = get_board_names(segment_csv_list, 'segment')
+@app.route('/api/leaderboards')
+def api_leaderboards():
+    return board_api_response('athlete')
 
-    return render_template('diffboards.html', 
-                            diffboards_and_names=zip(diffboards, diffboard_names))
+@app.route('/api/heinousboards')
+def api_diffboards():
+    return board_api_response('segment')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
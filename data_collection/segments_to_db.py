@@ -1,82 +1,277 @@
+import os
 import time
 import json
-import requests
-from sys import stdout
-from pymongo import MongoClient
+from datetime import datetime
+from sys import stdout, argv
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from strava_client import StravaClient, get_page_numbers
 
 class StravaSegmentsGetter(object):
-    def __init__(self):
+    def __init__(self, num_threads=8, url_base='https://www.strava.com/api/v3/', batch_size=2000,
+                 resume=True):
         with open('./.strava.json') as f:
             data = json.loads(f.read())
             access_token = data["TOKEN"]
         client = MongoClient()
         db = client['Strava']
         self.table = db['segment_efforts']
-        self.header =  {'Authorization' : 'Bearer %s' % access_token}
-        self.url_base = 'https://www.strava.com/api/v3/'
+        self.table.create_index('id')
+        self.table.create_index('segment.id')
+        # One document per segment: pages committed so far, whether it finished and the latest
+        # effort start seen by a delta sync
+        self.checkpoints = db['ingest_checkpoints']
+        self.client = StravaClient(access_token, url_base=url_base, num_threads=num_threads)
         self.page_max = 200
+        self.batch_size = batch_size
+        self.resume = resume
+        # Open delta file a sync also writes crawled batches to
+        self.delta_file = None
 
     def get_segments_efforts(self, segments):
         # Initialize variables for retrieval process
         self.segments = segments
         self.total_efforts = 0
 
-        self.current_segment = None
-
         # Start retrieval process
         self.time_init = time.time()
         self.get_insert_efforts()
         self.print_final_metrics()
 
     def get_insert_efforts(self):
+        committed_pages = {}
         for i, segment in enumerate(self.segments, 1):
-            if self.table.find_one({'segment.id': segment}):
+            checkpoint = self.checkpoints.find_one({'_id': segment}) or {}
+            if checkpoint.get('complete') or ('committed_pages' not in checkpoint and 
+                                              self.seed_checkpoint(segment)):
                 print '{}) Skipped segment {}, already in database'.format(i, segment)
                 continue
-            print '{}) Starting segment {}'.format(i, segment)
-            self.current_segment = segment
-            self.get_insert_current_segment_efforts()
+            committed_pages[segment] = set(checkpoint.get('committed_pages', []) 
+                                           if self.resume else [])
+            if committed_pages[segment]:
+                print '{}) Resuming segment {} after {} committed pages'.format(
+                                                    i, segment, len(committed_pages[segment]))
+            else:
+                print '{}) Starting segment {}'.format(i, segment)
+        if committed_pages:
+            self.get_insert_segments_efforts(committed_pages)
+
+    def seed_checkpoint(self, segment):
+        '''
+        Input: Segment id without a crawl checkpoint
+        Output: True if the segment already has stored efforts, it is now checkpointed as complete
 
-    def get_insert_current_segment_efforts(self):
-        self.get_time_current_segment_efforts()
-        self.insert_current_segment_efforts()
+        Segments crawled before checkpoints existed only have their stored efforts. Their effort
+        counts have grown since, so rather than crawling them again their newer efforts are left
+        to sync_segments_efforts
+        '''
+        if not self.table.find_one({'segment.id': segment}, {'_id': 1}):
+            return False
+        self.checkpoints.update_one({'_id': segment}, {'$set': {'complete': True}}, upsert=True)
+        return True
 
-    def get_time_current_segment_efforts(self):
+    def get_insert_segments_efforts(self, committed_pages):
+        '''
+        Input: Dictionary of segment id, set of the pages a previous run committed
+        Output: None
+
+        Pages of every segment are fetched together, so segments with only a page or two do not
+        leave the other threads idle. Efforts are upserted in bounded batches that can span
+        segments, each batch checkpointing its pages under their own segment, and a segment is
+        marked complete once all of its pages are committed
+        '''
         self.time = time.time()
-        self.current_efforts = self.get_current_segment_efforts()
+        segments = list(committed_pages)
+        self.effort_counts = self.client.get_effort_counts(segments)
+        self.remaining_pages = {segment: set(get_page_numbers(self.effort_counts[segment], 
+                                                               self.page_max)) - 
+                                         committed_pages[segment] for segment in segments}
+        self.total_pages = sum(len(pages) for pages in self.remaining_pages.values())
+        self.complete_segments([segment for segment in segments 
+                                if not self.remaining_pages[segment]])
+        self.update_effort_acquisition(0)
+
+        # Only fetch pages a previous run did not commit, they arrive concurrently and out of order
+        pages = enumerate(self.client.iter_segments_efforts(segments, self.page_max, 
+                                                            self.effort_counts, committed_pages), 1)
+        batch, batch_pages = [], []
+        inserted = self.total_efforts
+        for fetched, (segment, page, page_efforts) in pages:
+            batch.extend(effort for effort in page_efforts if isinstance(effort, dict))
+            batch_pages.append((segment, page))
+            if len(batch) >= self.batch_size:
+                self.commit_batch(batch, batch_pages)
+                batch, batch_pages = [], []
+            self.update_effort_acquisition(fetched)
+        self.commit_batch(batch, batch_pages)
+
         stdout.flush()
-        print '   Retrieved {} efforts in {:.2f} minutes '.format(len(self.current_efforts), 
-                                                            (time.time() - self.time)/60) + ' '*55
+        print '   Retrieved {} efforts of {} segments in {:.2f} minutes '.format(
+                self.total_efforts - inserted, len(segments), (time.time() - self.time)/60) + ' '*55
 
-    def get_current_segment_efforts(self):
-        self.current_segment_effort_count = requests.get(self.url_base + 
-                                            'segments/{}'.format(self.current_segment), 
-                                            headers=self.header).json()['effort_count']
-        self.update_effort_acquisition(0)
-        necessary_calls = range(1, self.current_segment_effort_count/self.page_max + 2)
-        return [effort for page in necessary_calls 
-                for effort in self.get_page_efforts(page)
-                if isinstance(effort, dict)]
-
-    def get_page_efforts(self, page):
-        page_efforts = requests.get(self.url_base + 
-                                    'segments/{}/all_efforts'.format(self.current_segment), 
-                                    headers=self.header, 
-                                    params={'per_page': self.page_max, 'page': page}).json()
-        self.update_effort_acquisition(page)
-        time.sleep(1)
-        return page_efforts
+    def commit_batch(self, efforts, segment_pages):
+        self.upsert_efforts(efforts)
+        if self.delta_file:
+            self.write_delta(efforts, self.delta_file)
+
+        # Checkpoint each segment's pages, then finish the segments with none left to commit
+        pages = {}
+        for segment, page in segment_pages:
+            pages.setdefault(segment, []).append(page)
+        if pages:
+            self.checkpoints.bulk_write([UpdateOne({'_id': segment}, 
+                                                   {'$addToSet': {'committed_pages': 
+                                                                  {'$each': committed}},
+                                                    '$set': {'effort_count': 
+                                                             self.effort_counts[segment]}},
+                                                   upsert=True)
+                                         for segment, committed in pages.items()])
+        for segment, committed in pages.items():
+            self.remaining_pages[segment].difference_update(committed)
+        self.complete_segments([segment for segment in pages if not self.remaining_pages[segment]])
+        self.total_efforts += len(efforts)
+
+    def complete_segments(self, segments):
+        if segments:
+            self.checkpoints.bulk_write([UpdateOne({'_id': segment}, 
+                                                   {'$set': {'complete': True, 'effort_count': 
+                                                             self.effort_counts[segment]}},
+                                                   upsert=True) for segment in segments])
+
+    def upsert_efforts(self, efforts):
+        # Unordered upserts keyed on effort id, so pages written again on resume are not duplicated
+        if efforts:
+            self.table.bulk_write([ReplaceOne({'id': effort['id']}, effort, upsert=True) 
+                                   for effort in efforts], ordered=False)
+
+    def write_delta(self, efforts, f):
+        for effort in efforts:
+            effort.pop('_id', None)
+            f.write(json.dumps(effort) + '\n')
+
+    def sync_segments_efforts(self, segments, delta_dir='../data/deltas/'):
+        '''
+        Input: List of segment ids, Directory to write the delta files to
+        Output: Path of the delta file, one effort per json line like the raw efforts file
+
+        Fetches only the efforts started since each segment's high-water mark, the latest
+        start_date_local already stored. The marks only move once the delta file is in place, so
+        a crashed sync is simply run again. Segments with no mark yet, or an unfinished crawl, go
+        through the checkpointed crawl instead, so their whole history is written in bounded
+        batches
+        '''
+        self.time_init = time.time()
+        self.total_efforts = 0
+        # Local start dates can be up to a day ahead of utc
+        end_date_local = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 24*60*60))
+        marks = {segment: self.get_high_water_mark(segment) for segment in segments}
+        crawl = [segment for segment in segments if self.needs_crawl(segment, marks[segment])]
+        segment_dates = [(segment, mark[0]) for segment, mark in marks.items() 
+                         if segment not in crawl]
+
+        if not os.path.exists(delta_dir):
+            os.makedirs(delta_dir)
+        delta_path = os.path.join(delta_dir, 'efforts_{}.json'.format(
+                                                datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')))
+        # Marks found from the stored efforts are saved too, so the lookup only happens once
+        new_marks = {segment: mark for segment, mark in marks.items() if mark[0]}
+        with open(delta_path + '.tmp', 'w') as f:
+            self.delta_file = f
+            try:
+                self.segments = crawl
+                self.get_insert_efforts()
+            finally:
+                self.delta_file = None
+
+            efforts_iter = self.client.iter_segments_new_efforts(segment_dates, end_date_local, 
+                                                                 self.page_max)
+            for i, (segment, efforts) in enumerate(efforts_iter, len(crawl) + 1):
+                new_efforts = self.get_new_efforts(efforts, marks[segment])
+                self.upsert_efforts(new_efforts)
+                self.write_delta(new_efforts, f)
+                if new_efforts:
+                    new_marks[segment] = self.get_latest(new_efforts, marks[segment])
+                self.total_efforts += len(new_efforts)
+                print '{}) Synced {} new efforts for segment {}'.format(i, len(new_efforts), 
+                                                                        segment)
+        os.rename(delta_path + '.tmp', delta_path)
+
+        # Crawled segments take their marks from the efforts they stored
+        for segment in crawl:
+            mark = self.get_high_water_mark(segment)
+            if mark[0]:
+                new_marks[segment] = mark
+        if new_marks:
+            self.checkpoints.bulk_write([UpdateOne({'_id': segment}, 
+                                                   {'$set': {'latest_start_date_local': date, 
+                                                             'latest_ids': ids}}, upsert=True)
+                                         for segment, (date, ids) in new_marks.items()])
+        self.print_final_metrics()
+        return delta_path
+
+    def needs_crawl(self, segment, mark):
+        '''
+        Input: Segment id, its high-water mark
+        Output: True if the segment should be crawled rather than synced from its mark
+
+        A segment whose finished crawl stored no efforts is crawled again from the start
+        '''
+        checkpoint = self.checkpoints.find_one({'_id': segment}) or {}
+        if mark[0] is None and checkpoint.get('complete'):
+            self.checkpoints.update_one({'_id': segment}, 
+                                        {'$unset': {'complete': '', 'committed_pages': ''}})
+            return True
+        return mark[0] is None or ('committed_pages' in checkpoint and 
+                                   not checkpoint.get('complete'))
+
+    def get_high_water_mark(self, segment):
+        '''
+        Input: Segment id
+        Output: Tuple of the latest start_date_local stored for the segment (None if it has no
+                efforts yet) and the list of effort ids started at exactly that date
+        '''
+        checkpoint = self.checkpoints.find_one({'_id': segment}) or {}
+        if 'latest_start_date_local' in checkpoint:
+            return checkpoint['latest_start_date_local'], checkpoint['latest_ids']
+        # Segments crawled before delta syncs existed take their mark from the stored efforts
+        latest = self.table.find_one({'segment.id': segment}, {'start_date_local': 1}, 
+                                     sort=[('start_date_local', -1)])
+        if not latest:
+            return None, []
+        date = latest['start_date_local']
+        ids = [effort['id'] for effort in self.table.find({'segment.id': segment, 
+                                                            'start_date_local': date}, {'id': 1})]
+        return date, ids
+
+    def get_new_efforts(self, efforts, mark):
+        '''
+        Input: List of efforts fetched from the segment's high-water mark, the high-water mark
+        Output: List of the efforts not yet stored
+
+        The api's date window includes its start, so efforts at exactly the mark are compared by id
+        '''
+        date, ids = mark
+        ids = set(ids)
+        return [effort for effort in efforts if isinstance(effort, dict) and 
+                (date is None or effort['start_date_local'] > date or 
+                 (effort['start_date_local'] == date and effort['id'] not in ids))]
+
+    def get_latest(self, efforts, mark):
+        '''
+        Input: List of new efforts, the previous high-water mark
+        Output: The new high-water mark, the latest start_date_local and the ids started then
+        '''
+        date = max(effort['start_date_local'] for effort in efforts)
+        ids = [effort['id'] for effort in efforts if effort['start_date_local'] == date]
+        if date == mark[0]:
+            ids.extend(mark[1])
+        return date, ids
 
     def update_effort_acquisition(self, page):
-        percent_complete = float(page) / (self.current_segment_effort_count/self.page_max + 2) * 100
+        percent_complete = float(page) / max(self.total_pages, 1) * 100
         time_elapsed = time.time() - self.time
         eta = (time_elapsed * 1/(percent_complete/100)) - time_elapsed if page else 100000
         stdout.flush()
-        stdout.write('   Retrieving {} efforts: {:.1f}% complete --- Estimated time remaining: {:.1f} seconds            \r'.format(self.current_segment_effort_count, percent_complete, eta))
-
-    def insert_current_segment_efforts(self):
-        self.table.insert_many(self.current_efforts)
-        self.total_efforts += len(self.current_efforts)
+        stdout.write('   Retrieving {} pages: {:.1f}% complete --- Estimated time remaining: {:.1f} seconds            \r'.format(self.total_pages, percent_complete, eta))
 
     def print_final_metrics(self):
         total_mins = (time.time() - self.time_init)/60
@@ -99,5 +294,9 @@ if __name__ == '__main__':
                 774591, 351211}
     
     segment_getter = StravaSegmentsGetter()
-    segment_getter.get_segments_efforts(finished)
+    # python segments_to_db.py sync fetches only the efforts since the last run
+    if 'sync' in argv[1:]:
+        segment_getter.sync_segments_efforts(finished)
+    else:
+        segment_getter.get_segments_efforts(finished)
 
@@ -0,0 +1,294 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+
+# Strava's default quotas, (requests, seconds): 600 every 15 minutes and 30000 a day. Each one is
+# a fixed window, reset on the quarter hour and at midnight UTC
+strava_rate_limits = ((600, 15 * 60), (30000, 24 * 60 * 60))
+
+def get_page_numbers(effort_count, per_page=200):
+    '''
+    Input: Number of efforts on a segment, efforts per page
+    Output: List of the page numbers holding them, the last one possibly empty
+    '''
+    return range(1, effort_count // per_page + 2)
+
+class FixedWindow(object):
+    '''
+    Thread safe count of the requests made in the current fixed window of a quota, allowing
+    capacity requests per window. Windows are aligned to the epoch, so 15 minute windows reset on
+    the quarter hour and daily windows at midnight UTC, like Strava's
+    '''
+    def __init__(self, capacity, period):
+        '''
+        Input: Number of requests allowed per window, Length of the window in seconds
+        '''
+        self.capacity = capacity
+        self.period = period
+        self.window = None
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def roll(self, now):
+        '''
+        Function to start counting again once a new window has begun, must hold the lock
+        Output: End time of the current window
+        '''
+        window = int(now // self.period)
+        if window != self.window:
+            self.window, self.used = window, 0
+        return (window + 1) * self.period
+
+    def acquire(self):
+        '''
+        Function to count a request, blocking until the next window if this one is used up
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                window_end = self.roll(now)
+                if self.used < self.capacity:
+                    self.used += 1
+                    return
+            time.sleep(window_end - now)
+
+    def set_usage(self, usage, limit=None):
+        '''
+        Input: Number of requests the server says were made in the current window, Its limit for
+               the window
+        Output: None
+
+        Only ever raises the count, so requests other clients made against the same quota count.
+        Usage at or over the limit blocks every thread until the window resets
+        '''
+        with self.lock:
+            self.roll(time.time())
+            if limit is not None:
+                self.capacity = limit
+            self.used = max(self.used, usage)
+
+    def exhaust(self):
+        '''
+        Function to use up the current window, so every thread waits for the next one
+        '''
+        with self.lock:
+            self.roll(time.time())
+            self.used = max(self.used, self.capacity)
+
+    def is_exhausted(self):
+        with self.lock:
+            self.roll(time.time())
+            return self.used >= self.capacity
+
+class RateLimiter(object):
+    '''
+    Fixed windows for each of a set of quotas, a request waits until every quota allows it
+    '''
+    def __init__(self, limits=strava_rate_limits):
+        '''
+        Input: Tuple of (requests, seconds) quotas, shortest period first
+        '''
+        self.windows = [FixedWindow(capacity, period) for capacity, period in limits]
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            wait = self.blocked_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        for window in self.windows:
+            window.acquire()
+
+    def update_from_headers(self, headers):
+        '''
+        Input: Response headers
+        Output: None
+
+        Syncs the windows with Strava's X-RateLimit-Limit and X-RateLimit-Usage headers,
+        comma separated values in the same order as the quotas
+        '''
+        limits, usages = headers.get('X-RateLimit-Limit'), headers.get('X-RateLimit-Usage')
+        if not limits or not usages:
+            return
+        for window, limit, usage in zip(self.windows, limits.split(','), usages.split(',')):
+            window.set_usage(int(usage), int(limit))
+
+    def exhaust(self, retry_after=None):
+        '''
+        Input: Seconds the server asked to wait in a Retry-After header, None if it sent none
+        Output: None
+
+        Called after a 429. If the headers already showed a quota used up, every thread waits
+        for that quota's window to reset. Otherwise waits retry_after, or for the shortest
+        quota's window to reset
+        '''
+        if any(window.is_exhausted() for window in self.windows):
+            return
+        if retry_after is not None:
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+        else:
+            self.windows[0].exhaust()
+
+class StravaClient(object):
+    '''
+    Thread pooled, rate limited Strava api client sharing one keep-alive connection pool
+    '''
+    def __init__(self, access_token, url_base='https://www.strava.com/api/v3/', num_threads=8,
+                 limiter=None, max_retries=5, backoff=1., timeout=60, session=None):
+        '''
+        Input: Strava access token, Base url of the api (point it at a local mock server to test),
+               Number of pages to fetch at once, RateLimiter to share, defaults to Strava's quotas,
+               Number of retries for server errors, Seconds of the first retry's backoff
+               (doubled each retry), Seconds to wait on a response, Optional requests Session
+        '''
+        self.url_base = url_base
+        self.num_threads = num_threads
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Authorization': 'Bearer %s' % access_token})
+
+    def get(self, path, params=None):
+        '''
+        Input: Api path relative to url_base, Query parameters
+        Output: Decoded json response
+
+        Waits on the rate limiter before each request. A 429 means a quota is used up, so the
+        request waits for the quota to reset and is sent again, without counting as a retry.
+        Server errors back off exponentially, honoring Retry-After when it is sent
+        '''
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = self.session.get(self.url_base + path, params=params, timeout=self.timeout)
+            self.limiter.update_from_headers(response.headers)
+            retry_after = response.headers.get('Retry-After')
+
+            if response.status_code == 429:
+                self.limiter.exhaust(float(retry_after) if retry_after else None)
+                continue
+
+            if response.status_code >= 500:
+                if attempt == self.max_retries:
+                    break
+                time.sleep(float(retry_after) if retry_after else self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return response.json()
+        response.raise_for_status()
+
+    def get_segment(self, segment):
+        '''
+        Input: Segment id
+        Output: Dictionary of the segment's details
+        '''
+        return self.get('segments/{}'.format(segment))
+
+    def get_page_efforts(self, segment, page, per_page=200, start_date_local=None, 
+                         end_date_local=None):
+        '''
+        Input: Segment id, page number, efforts per page, Optional ISO 8601 local dates to only
+               return efforts started between them
+        Output: List of the efforts on that page
+        '''
+        params = {'per_page': per_page, 'page': page}
+        if start_date_local:
+            params.update({'start_date_local': start_date_local, 'end_date_local': end_date_local})
+        return self.get('segments/{}/all_efforts'.format(segment), params=params)
+
+    def get_new_efforts(self, segment, start_date_local=None, end_date_local=None, per_page=200):
+        '''
+        Input: Segment id, ISO 8601 local date to fetch efforts from, None for the whole history,
+               ISO 8601 local date to fetch efforts until, efforts per page
+        Output: List of the efforts started in the window
+
+        The number of efforts in the window is unknown, so pages are read in order until one
+        comes back short
+        '''
+        efforts, page = [], 1
+        while True:
+            page_efforts = self.get_page_efforts(segment, page, per_page, start_date_local, 
+                                                 end_date_local)
+            efforts.extend(page_efforts)
+            if len(page_efforts) < per_page:
+                return efforts
+            page += 1
+
+    def iter_pages(self, segment_pages, per_page=200):
+        '''
+        Input: List of (segment id, page number) pairs, possibly for many segments, efforts per page
+        Output: Generator of (segment id, page number, list of efforts), in completion order
+
+        Fetches num_threads pages at a time over the shared connection pool
+        '''
+        def fetch(segment_page):
+            segment, page = segment_page
+            return segment, page, self.get_page_efforts(segment, page, per_page)
+
+        pool = ThreadPool(self.num_threads)
+        try:
+            for result in pool.imap_unordered(fetch, segment_pages):
+                yield result
+        finally:
+            pool.terminate()
+
+    def get_effort_counts(self, segments):
+        '''
+        Input: List of segment ids
+        Output: Dictionary of segment id, number of efforts, looked up num_threads at a time
+        '''
+        pool = ThreadPool(self.num_threads)
+        try:
+            effort_counts = pool.map(lambda segment: self.get_segment(segment)['effort_count'],
+                                     segments)
+        finally:
+            pool.terminate()
+        return dict(zip(segments, effort_counts))
+
+    def iter_segments_efforts(self, segments, per_page=200, effort_counts=None, 
+                              committed_pages=None):
+        '''
+        Input: List of segment ids, efforts per page, Dictionary of segment id, number of efforts,
+               None to look them up, Dictionary of segment id, pages to skip
+        Output: Generator of (segment id, page number, list of efforts) for every page of every
+                segment, fetched concurrently across segments
+        '''
+        effort_counts = effort_counts or self.get_effort_counts(segments)
+        committed_pages = committed_pages or {}
+        segment_pages = [(segment, page) for segment in segments 
+                         for page in get_page_numbers(effort_counts[segment], per_page)
+                         if page not in committed_pages.get(segment, ())]
+        return self.iter_pages(segment_pages, per_page)
+
+    def iter_segments_new_efforts(self, segment_dates, end_date_local, per_page=200):
+        '''
+        Input: List of (segment id, ISO 8601 local date or None) pairs, ISO 8601 local date to
+               fetch efforts until, efforts per page
+        Output: Generator of (segment id, list of efforts started since that segment's date), in
+                completion order
+
+        Segments are fetched num_threads at a time, each usually needing a single page
+        '''
+        def fetch(segment_date):
+            segment, start_date_local = segment_date
+            return segment, self.get_new_efforts(segment, start_date_local, end_date_local, 
+                                                 per_page)
+
+        pool = ThreadPool(self.num_threads)
+        try:
+            for result in pool.imap_unordered(fetch, segment_dates):
+                yield result
+        finally:
+            pool.terminate()
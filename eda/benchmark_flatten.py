@@ -0,0 +1,58 @@
+import sys
+import time
+import pandas as pd
+from strava_db import EffortDfGetter
+
+def apply_flatten(df):
+    '''
+    Input: Raw effort DataFrame
+    Output: None
+
+    Original flattening path, one python level apply over the frame per nested key
+    '''
+    for column in ['athlete', 'segment', 'activity']:
+        df['{}_id'.format(column)] = df[column].apply(lambda x: x['id'])
+    for category in ['average_grade', 'distance', 'elevation_low', 'elevation_high', 
+                     'maximum_grade']:
+        df['seg_{}'.format(category)] = df.segment.apply(lambda x: x[category])
+
+def vectorized_flatten(df):
+    '''
+    Input: Raw effort DataFrame
+    Output: None
+
+    Current flattening path, EffortDfGetter.flatten_nested_columns
+    '''
+    df_getter = EffortDfGetter()
+    df_getter.df = df
+    df_getter.flatten_nested_columns()
+
+def time_flatten(flatten, df, repeats=3):
+    '''
+    Input: Flattening function, raw effort DataFrame, number of times to run it
+    Output: Best wall-clock seconds over the repeats
+    '''
+    times = []
+    for _ in range(repeats):
+        df_copy = df.copy()
+        t = time.time()
+        flatten(df_copy)
+        times.append(time.time() - t)
+    return min(times)
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    df = EffortDfGetter(origin='json').get_df_from_json().iloc[:size]
+    print 'Flattening {} efforts'.format(df.shape[0])
+
+    # Both paths have to agree before their timings mean anything
+    apply_df, vectorized_df = df.copy(), df.copy()
+    apply_flatten(apply_df)
+    vectorized_flatten(vectorized_df)
+    pd.util.testing.assert_frame_equal(apply_df, vectorized_df[apply_df.columns])
+
+    apply_time = time_flatten(apply_flatten, df)
+    vectorized_time = time_flatten(vectorized_flatten, df)
+    print 'apply:      {:.2f} seconds'.format(apply_time)
+    print 'vectorized: {:.2f} seconds ({:.1f}x)'.format(vectorized_time, 
+                                                       apply_time / vectorized_time)
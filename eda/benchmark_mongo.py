@@ -0,0 +1,54 @@
+import sys
+import time
+import json
+import numpy as np
+import pandas as pd
+from itertools import islice
+from strava_db import EffortDfGetter
+
+def load_mock_client(json_path, size):
+    '''
+    Input: Path to the raw json file, Number of efforts to load
+    Output: mongomock MongoClient with the efforts in Strava.segment_efforts
+    '''
+    import mongomock
+    client = mongomock.MongoClient()
+    with open(json_path) as f:
+        client['Strava']['segment_efforts'].insert_many(json.loads(line) 
+                                                        for line in islice(f, size))
+    return client
+
+def time_get(df_getter, size, repeats=3):
+    '''
+    Input: EffortDfGetter reading from mongo, Number of efforts to retrieve, number of runs
+    Output: Best wall-clock seconds over the repeats, Clean DataFrame from the last run
+    '''
+    times = []
+    for _ in range(repeats):
+        t = time.time()
+        df = df_getter.get(size)
+        times.append(time.time() - t)
+    return min(times), df
+
+if __name__ == '__main__':
+    # python benchmark_mongo.py [size] [mock], mock loads the raw json file into mongomock instead
+    # of reading a local mongod
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    client = load_mock_client('../data/efforts.json', size) if 'mock' in sys.argv[2:] else None
+
+    find_time, find_df = time_get(EffortDfGetter(origin='mongo', mongo_client=client), size)
+    stream_time, stream_df = time_get(EffortDfGetter(origin='mongo', chunk_size=100000, 
+                                                     mongo_client=client), size)
+    print 'Read {} efforts'.format(stream_df.shape[0])
+
+    # Both paths have to agree before their timings mean anything, up to the streamed float32s
+    columns = [column for column in stream_df.select_dtypes(include=[np.number]).columns 
+               if column in find_df.columns]
+    np.testing.assert_allclose(find_df[columns].values.astype(float), 
+                               stream_df[columns].values.astype(float), rtol=1e-5, atol=1e-3)
+
+    print 'find:     {:.2f} seconds, {:.1f} MB'.format(find_time, 
+                                                   find_df.memory_usage(deep=True).sum() / 1e6)
+    print 'streamed: {:.2f} seconds, {:.1f} MB ({:.1f}x)'.format(stream_time, 
+                                                   stream_df.memory_usage(deep=True).sum() / 1e6,
+                                                   find_time / stream_time)
@@ -4,7 +4,7 @@ from strava_db import EffortDfGetter
 
 if __name__ == '__main__':
     t = time.time()
-    df_getter = EffortDfGetter(origin='json')
+    df_getter = EffortDfGetter(origin='json', chunk_size=100000, cache=True)
     df = df_getter.get()
     print 'Retrieved dataframe with {} efforts in {:.2f} seconds'.format(df.shape[0], time.time()-t)
 
@@ -1,33 +1,403 @@
+import os
+import sys
 import json
+import hashlib
 import numpy as np
 import pandas as pd
+from itertools import islice
 from pymongo import MongoClient
+sys.path.append('../modeling')
+from file_io import atomic_write, atomic_directory
+
+# Flat column name, nested dictionary it lives in, and key inside that dictionary
+nested_fields = [('athlete_id', 'athlete', 'id'),
+                 ('segment_id', 'segment', 'id'),
+                 ('activity_id', 'activity', 'id'),
+                 ('seg_average_grade', 'segment', 'average_grade'),
+                 ('seg_distance', 'segment', 'distance'),
+                 ('seg_elevation_low', 'segment', 'elevation_low'),
+                 ('seg_elevation_high', 'segment', 'elevation_high'),
+                 ('seg_maximum_grade', 'segment', 'maximum_grade')]
+
+# Compact dtypes for every column kept when streaming the raw json file
+streamed_column_dtypes = {'athlete_id': np.int64,
+                          'segment_id': np.int64,
+                          'activity_id': np.int64,
+                          'seg_average_grade': np.float32,
+                          'seg_distance': np.float32,
+                          'seg_elevation_low': np.float32,
+                          'seg_elevation_high': np.float32,
+                          'seg_maximum_grade': np.float32,
+                          'start_date_local': 'datetime64[ns]',
+                          'elapsed_time': np.int32,
+                          'moving_time': np.int32,
+                          'distance': np.float32,
+                          'average_cadence': np.float32,
+                          'average_heartrate': np.float32}
+
+# Server side projection of just the fields the streamed columns are built from
+mongo_projection = dict([('_id', 0)] + 
+                        [('{}.{}'.format(nested, key), 1) for _, nested, key in nested_fields] +
+                        [(name, 1) for name in set(streamed_column_dtypes) - 
+                                               {name for name, _, _ in nested_fields}])
+
+# Indexes the efforts collection is expected to have
+effort_indexes = ['segment.id', 'athlete.id', 'start_date']
+
+# DataFrame query comparison operators and their mongo equivalents
+mongo_operators = {'>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte', '==': '$eq', '!=': '$ne'}
+
+# Effort speed and usefulness as computed by engineer_features and remove_useless_rows
+mongo_speed = {'$divide': ['$distance', '$elapsed_time']}
+mongo_useful_match = {'moving_time': {'$gt': 0}}
+
+def query_to_match(query):
+    '''
+    Input: DataFrame query string of 'column operator number' comparisons joined by 'and', None
+           for every effort
+    Output: Equivalent mongo filter on the raw effort documents
+    '''
+    # Flat column names map back to their place in the nested dictionaries
+    paths = {name: '{}.{}'.format(nested, key) for name, nested, key in nested_fields}
+
+    match = {}
+    for comparison in (query.split(' and ') if query else []):
+        column, operator, value = comparison.split()
+        match.setdefault(paths.get(column, column), {})[mongo_operators[operator]] = float(value)
+    return match
+
+def group_means(values, codes, num_groups):
+    '''
+    Input: Array of values, array of their integer group codes, number of groups
+    Output: Array of the mean value for each group
+    '''
+    sums = np.bincount(codes, weights=values, minlength=num_groups)
+    return sums / np.bincount(codes, minlength=num_groups)
+
+def group_stds(values, codes, num_groups):
+    '''
+    Input: Array of values, array of their integer group codes, number of groups
+    Output: Array of the sample standard deviation for each group, NaN for single value groups
+    '''
+    counts = np.bincount(codes, minlength=num_groups).astype(np.float64)
+    means = np.bincount(codes, weights=values, minlength=num_groups) / counts
+    squares = np.bincount(codes, weights=(values - means[codes]) ** 2, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(squares / (counts - 1))
+
+def group_quantiles(values, codes, num_groups, quantiles):
+    '''
+    Input: Array of values, array of their integer group codes, number of groups,
+           List of quantiles between 0 and 1
+    Output: List of arrays, the linearly interpolated quantile for each group, one per quantile
+    '''
+    # Sort values within their groups so each group is a contiguous, ordered run
+    sorted_values = values[np.lexsort((values, codes))]
+    counts = np.bincount(codes, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    last = len(sorted_values) - 1
+
+    group_quantiles = []
+    for quantile in quantiles:
+        position = starts + quantile * np.maximum(counts - 1, 0)
+        below = np.minimum(np.floor(position).astype(np.int64), last)
+        above = np.minimum(np.ceil(position).astype(np.int64), last)
+        fraction = position - below
+        group_quantiles.append(sorted_values[below] * (1 - fraction) + 
+                               sorted_values[above] * fraction)
+    return group_quantiles
+
+def k_sigma_rule(speeds, predicted_speeds, segment_codes, num_segments, k):
+    '''
+    Input: Array of effort speeds, array of predicted speeds, array of segment codes,
+           number of segments, number of standard deviations allowed
+    Output: Boolean array, True for efforts within k segment speed stds of their predicted speed
+    '''
+    segment_speed_std = group_stds(speeds, segment_codes, num_segments)
+    return np.abs(predicted_speeds - speeds) < k * segment_speed_std[segment_codes]
+
+def mad_rule(speeds, predicted_speeds, segment_codes, num_segments, k):
+    '''
+    Input: Array of effort speeds, array of predicted speeds, array of segment codes,
+           number of segments, number of scaled median absolute deviations allowed
+    Output: Boolean array, True for efforts within k segment speed MADs of their predicted speed
+    '''
+    segment_median, = group_quantiles(speeds, segment_codes, num_segments, [.5])
+    deviations = np.abs(speeds - segment_median[segment_codes])
+    segment_mad, = group_quantiles(deviations, segment_codes, num_segments, [.5])
+
+    # Scale MAD so it estimates a standard deviation for normally distributed speeds
+    return np.abs(predicted_speeds - speeds) < k * 1.4826 * segment_mad[segment_codes]
+
+def iqr_rule(speeds, predicted_speeds, segment_codes, num_segments, k):
+    '''
+    Input: Array of effort speeds, array of predicted speeds, array of segment codes,
+           number of segments, number of interquartile ranges allowed outside the quartiles
+    Output: Boolean array, True for efforts whose residual from their predicted speed is within
+            k IQRs of their segment's residual quartiles
+    '''
+    residuals = speeds - predicted_speeds
+    q1, q3 = group_quantiles(residuals, segment_codes, num_segments, [.25, .75])
+    iqr = q3 - q1
+    return ((residuals >= (q1 - k * iqr)[segment_codes]) & 
+            (residuals <= (q3 + k * iqr)[segment_codes]))
+
+# Outlier rules EffortDfGetter can be asked for by name
+outlier_rules = {'k_sigma': k_sigma_rule, 
+                 'mad': mad_rule, 
+                 'iqr': iqr_rule}
+
+class IdCodes(object):
+    '''
+    Persistent dictionary of Strava ids to dense int32 codes. Ids it has not seen are appended
+    after the existing ones, so a code never changes once given out
+    '''
+    def __init__(self, ids=None):
+        '''
+        Input: Array of ids in code order, None for an empty dictionary
+        '''
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int64)
+        self.sort_ids()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sort_ids(self):
+        '''
+        Function to sort the ids, with each one's code, for binary search lookups
+        '''
+        self.id_order = np.argsort(self.ids, kind='mergesort').astype(np.int32)
+        self.sorted_ids = self.ids[self.id_order]
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Input: Path of an IdCodes stored with save, a missing file gives an empty dictionary
+        Output: IdCodes
+        '''
+        return cls(np.load(path) if os.path.exists(path) else None)
+
+    def save(self, path):
+        '''
+        Input: Path to store the ids at, an .npy file
+        Output: None
+        '''
+        # Written atomically, so a crash never truncates the codes
+        with atomic_write(path, 'wb') as f:
+            np.save(f, self.ids)
+
+    def get_codes(self, ids):
+        '''
+        Input: Array of ids
+        Output: Array of their int32 codes, -1 for ids not in the dictionary
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1, dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.ids) - 1)
+        return np.where(self.sorted_ids[positions] == ids, self.id_order[positions], 
+                        -1).astype(np.int32)
+
+    def encode(self, ids):
+        '''
+        Input: Array of ids
+        Output: Array of their int32 codes, appending any new ids in order of first appearance
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        codes = self.get_codes(ids)
+        new = codes < 0
+        if new.any():
+            self.ids = np.concatenate([self.ids, pd.unique(ids[new])])
+            self.sort_ids()
+            codes[new] = self.get_codes(ids[new])
+        return codes
+
+    def decode(self, codes):
+        '''
+        Input: Array of codes
+        Output: Array of their ids
+
+        Raises ValueError for codes outside the dictionary, such as the -1 get_codes gives unseen
+        ids, rather than letting numpy wrap negative codes around to the last ids
+        '''
+        codes = np.asarray(codes, dtype=np.int64)
+        if codes.size and (codes.min() < 0 or codes.max() >= len(self.ids)):
+            raise ValueError('Codes must be between 0 and {}, got {} to {}'
+                             .format(len(self.ids) - 1, codes.min(), codes.max()))
+        return self.ids[codes]
 
 class EffortDfGetter(object):
     '''
     Class for retrieving a DataFrame with Strava efforts from either raw json file or mongo database
     '''
-    def __init__(self, origin='json'):
+    def __init__(self, origin='json', chunk_size=None, cache=False, 
+                 json_path='../data/efforts.json', cache_path='../data/cache/',
+                 outlier_rule='k_sigma', outlier_k=4, mongo_client=None, id_path='../data/ids/'):
         '''
-        Input: String specifiying where the original data is coming from
+        Input: String specifiying where the original data is coming from,
+               Number of json lines or mongo documents to parse at a time, None to parse them all
+               at once,
+               Whether to store/load the cleaned json DataFrame in a columnar cache,
+               Path to the raw json file, Directory the columnar caches are kept in,
+               Name of an outlier rule in outlier_rules or a function with the same signature,
+               Width of the inlier band passed to the outlier rule,
+               MongoClient to read efforts from, defaults to a local mongod,
+               Directory the athlete and segment id codes are kept in, None to not add codes
         '''
         self.origin = origin
+        self.mongo_client = mongo_client
+        self.id_path = id_path
+        self.outlier_rule = outlier_rule
+        self.outlier_k = outlier_k
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.json_path = json_path
+        self.cache_path = cache_path
 
-    def get(self, size=False):
+    def get(self, size=False, columns=None):
         '''
-        Input: Size if origin is mongo
+        Input: Size if origin is mongo, List of columns to return, None for all of them
         Output: Clean DataFrame of Strava efforts
         '''
-        self.df = self.get_df_from_json() if self.origin == 'json' else self.get_df_from_mongo(size)
-        self.transform_df()
+        if self.cache and self.origin == 'json':
+            # Codes are added after loading, so cached DataFrames always agree with the dictionary,
+            # the caches only hold the ids they are encoded from
+            code_columns = {'athlete_code', 'segment_code'} if self.id_path else set()
+            id_columns = {'athlete_id', 'segment_id'} if self.id_path else set()
+            self.df = self.get_cached_df(columns and 
+                                         list(id_columns | (set(columns) - code_columns)))
+        else:
+            self.df = self.get_df_from_json() if self.origin == 'json' else \
+                      self.get_df_from_mongo(size)
+            self.transform_df()
+        if self.id_path:
+            self.add_id_codes(self.df)
+        return self.df[columns] if columns else self.df
+
+    def add_id_codes(self, df):
+        '''
+        Input: DataFrame with athlete_id and segment_id columns
+        Output: None
+
+        Adds athlete_code and segment_code columns of dense int32 codes from the persistent id 
+        dictionaries, so later stages can join and aggregate by array indexing
+        '''
+        if not os.path.exists(self.id_path):
+            os.makedirs(self.id_path)
+        for name in ['athlete', 'segment']:
+            path = os.path.join(self.id_path, '{}_ids.npy'.format(name))
+            id_codes = IdCodes.load(path)
+            num_ids = len(id_codes)
+            df['{}_code'.format(name)] = id_codes.encode(df['{}_id'.format(name)].values)
+            if len(id_codes) > num_ids:
+                id_codes.save(path)
+            setattr(self, '{}_codes'.format(name), id_codes)
+
+    def pipeline_settings(self):
+        '''
+        Output: Dictionary of the settings that change what the cleaned DataFrame looks like
+        '''
+        rule = getattr(self.outlier_rule, '__name__', self.outlier_rule)
+        return {'streamed': bool(self.chunk_size), 
+                'outlier_rule': rule, 
+                'outlier_k': self.outlier_k}
+
+    def get_cached_df(self, columns=None):
+        '''
+        Input: List of columns to load, None for all of them
+        Output: Clean DataFrame of Strava efforts, from the columnar cache when it is up to date
+
+        The cache key is the raw json file's checksum plus the pipeline settings, so a changed
+        file or pipeline gets its own cache rather than stale data
+        '''
+        cache_dir = os.path.join(self.cache_path, self.get_cache_key())
+        if not os.path.exists(cache_dir):
+            self.df = self.get_df_from_json()
+            self.transform_df()
+            self.store_cache(cache_dir)
+        return self.load_cache(cache_dir, columns)
+
+    def get_cache_key(self):
+        '''
+        Output: Hex digest of the raw json file's checksum and the pipeline settings
+        '''
+        settings = json.dumps(self.pipeline_settings(), sort_keys=True)
+        return hashlib.md5((self.get_json_checksum() + settings).encode('utf-8')).hexdigest()
+
+    def get_json_checksum(self):
+        '''
+        Output: md5 hex digest of the raw json file
+
+        Checksums are remembered next to the caches by file size and modification time, so the
+        multi-gigabyte file is only read again when it has actually changed
+        '''
+        stat = os.stat(self.json_path)
+        stamp = [os.path.abspath(self.json_path), stat.st_size, stat.st_mtime]
+
+        checksums_path = os.path.join(self.cache_path, 'checksums.json')
+        checksums = []
+        if os.path.exists(checksums_path):
+            with open(checksums_path) as f:
+                checksums = json.load(f)
+        for checksum_stamp, checksum in checksums:
+            if checksum_stamp == stamp:
+                return str(checksum)
+
+        md5 = hashlib.md5()
+        with open(self.json_path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                md5.update(block)
+        checksum = md5.hexdigest()
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+        with open(checksums_path, 'w') as f:
+            json.dump(checksums + [[stamp, checksum]], f)
+        return checksum
+
+    def store_cache(self, cache_dir):
+        '''
+        Input: Directory to store the cleaned DataFrame in
+        Output: None
+
+        Stores each column, and the index, as its own .npy file so later loads can memory-map just
+        the columns they need. Written as an atomic directory, so a crashed run never leaves a
+        half written cache behind
+        '''
+        with atomic_directory(cache_dir) as tmp_dir:
+            for column in self.df.columns:
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(column)), self.df[column].values)
+            np.save(os.path.join(tmp_dir, 'index.npy'), self.df.index.values)
+            with open(os.path.join(tmp_dir, 'columns.json'), 'w') as f:
+                json.dump(list(self.df.columns), f)
+
+    def load_cache(self, cache_dir, columns=None):
+        '''
+        Input: Directory the cleaned DataFrame is stored in, List of columns to load
+        Output: Clean DataFrame of Strava efforts with only the requested columns
+        '''
+        if not columns:
+            with open(os.path.join(cache_dir, 'columns.json')) as f:
+                columns = json.load(f)
+
+        # Memory-map each requested column, only object columns have to be read in fully
+        def load_column(name):
+            path = os.path.join(cache_dir, '{}.npy'.format(name))
+            try:
+                return np.load(path, mmap_mode='r')
+            except ValueError:
+                return np.load(path, allow_pickle=True)
+
+        self.df = pd.DataFrame({column: load_column(column) for column in columns}, 
+                               index=load_column('index'), 
+                               columns=columns)
         return self.df
 
     def transform_df(self):
         '''
         Helper function that calls all necessary functions to change DataFrame into proper type
         '''
-        self.make_id_cols()
-        self.get_segment_info()
+        self.flatten_nested_columns()
         self.make_date_col()
         self.engineer_features()
         self.remove_useless_rows()
@@ -39,46 +409,216 @@ class EffortDfGetter(object):
         Function to get data from raw json file
         Output: DataFrame from raw json file
         '''
-        with open('../data/efforts.json') as f:
+        if self.chunk_size:
+            return self.get_df_from_json_chunks()
+        with open(self.json_path) as f:
             return pd.DataFrame(json.loads(line) for line in f)
 
+    def get_df_from_json_chunks(self):
+        '''
+        Function to stream the raw json file chunk_size lines at a time, flattening the nested
+        dictionaries as it reads and filling preallocated, compactly typed column arrays
+        Output: DataFrame of only the streamed columns from raw json file
+        '''
+        # Count the efforts first so every column can be allocated once at its final size
+        with open(self.json_path) as f:
+            num_efforts = sum(1 for _ in f)
+        columns = {name: np.empty(num_efforts, dtype=dtype) 
+                   for name, dtype in streamed_column_dtypes.items()}
+
+        # Fill the columns one chunk at a time, so only one chunk of parsed dicts is ever in memory
+        start = 0
+        with open(self.json_path) as f:
+            for lines in iter(lambda: list(islice(f, self.chunk_size)), []):
+                chunk = self.flatten_json_chunk(lines)
+                stop = start + len(lines)
+                for name, values in chunk.items():
+                    columns[name][start:stop] = values
+                start = stop
+
+        return pd.DataFrame(columns, columns=sorted(streamed_column_dtypes))
+
+    def flatten_json_chunk(self, lines):
+        '''
+        Input: List of raw json lines, one effort per line
+        Output: Dictionary of column name, typed numpy array pairs for the chunk
+        '''
+        return self.flatten_efforts([json.loads(line) for line in lines])
+
+    def flatten_efforts(self, efforts):
+        '''
+        Input: List of effort dictionaries
+        Output: Dictionary of column name, typed numpy array pairs for the efforts
+        '''
+        # Pull the wanted keys out of the nested dictionaries
+        chunk = {name: [effort[nested][key] for effort in efforts] 
+                 for name, nested, key in nested_fields}
+
+        # Pull the wanted top level keys, missing values become NaN
+        top_level = set(streamed_column_dtypes) - set(chunk) - {'start_date_local'}
+        chunk.update({name: [effort.get(name) for effort in efforts] for name in top_level})
+
+        chunk = {name: np.array(values, dtype=streamed_column_dtypes[name]) 
+                 for name, values in chunk.items()}
+        chunk['start_date_local'] = pd.to_datetime([effort['start_date_local'] 
+                                                    for effort in efforts]).values
+        return chunk
+
     def get_df_from_mongo(self, size=False):
         '''
         Function to get data from raw json file
         Input: Size of dataframe to be retrieved
         Output: DataFrame from mongo database
         '''
-        client = MongoClient()
-        db = client['Strava']
-        table = db['segment_efforts']
+        table = self.get_mongo_table()
+        if self.chunk_size:
+            return self.get_df_from_mongo_chunks(table, size)
         if size:
             df = pd.DataFrame(list(table.find().limit(size)))
         else:
             df = pd.DataFrame(list(table.find()))
         return df
 
-    def make_id_cols(self):
+    def get_mongo_table(self):
+        '''
+        Output: Indexed efforts collection
+        '''
+        client = self.mongo_client or MongoClient()
+        table = client['Strava']['segment_efforts']
+        for index in effort_indexes:
+            table.create_index(index)
+        return table
+
+    def get_agg_dfs_from_mongo(self, querys, start_date=None, end_date=None):
+        '''
+        Input: Dictionary of subset name, DataFrame query string (None for every effort) pairs,
+               Optional dates to only aggregate efforts started after start_date and on or before 
+               end_date
+        Output: Dictionary of subset name, DataFrame of mean average_speed and effort_count per
+                athlete-segment pair
+
+        Builds the aggregates of the cleaned DataFrame in the database with aggregation pipelines,
+        so only the pair tables are sent over. Like remove_outliers, the k_sigma rule is applied
+        against speed statistics of every effort before subsetting
         '''
-        Function to parse ids from nested dictionaries
+        if getattr(self.outlier_rule, '__name__', self.outlier_rule) != 'k_sigma':
+            raise ValueError('Only the k_sigma outlier rule can be run in mongo')
+        table = self.get_mongo_table()
+        self.store_mongo_speed_stats(table)
+
+        # Dates compare as strings in the same format as start_date_local
+        dates = {}
+        if start_date:
+            dates['$gt'] = pd.Timestamp(start_date).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if end_date:
+            dates['$lte'] = pd.Timestamp(end_date).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        agg_dfs = {}
+        for name, query in querys.items():
+            match = dict(mongo_useful_match, **query_to_match(query))
+            if dates:
+                match['start_date_local'] = dates
+            agg_dfs[name] = self.get_mongo_agg_df(table, match)
+            if self.id_path:
+                self.add_id_codes(agg_dfs[name])
+        return agg_dfs
+
+    def store_mongo_speed_stats(self, table):
         '''
-        # Specify which column names have desired ids
-        columns = ['athlete', 'segment', 'activity']
+        Input: Efforts collection
+        Output: None
 
-        # Make a new column in the df from each of the ids
-        for column in columns:
-            self.df['{}_id'.format(column)] = self.df[column].apply(lambda x: x['id'])
+        Stores the average speed of every athlete in athlete_speeds and the average speed and 
+        speed std of every segment in segment_speeds, the statistics remove_outliers uses
+        '''
+        table.aggregate([{'$match': mongo_useful_match},
+                         {'$group': {'_id': '$athlete.id', 'speed': {'$avg': mongo_speed}}},
+                         {'$out': 'athlete_speeds'}], allowDiskUse=True)
+        table.aggregate([{'$match': mongo_useful_match},
+                         {'$group': {'_id': '$segment.id', 'speed': {'$avg': mongo_speed},
+                                     'std': {'$stdDevSamp': mongo_speed}}},
+                         {'$out': 'segment_speeds'}], allowDiskUse=True)
 
-    def get_segment_info(self):
+    def get_mongo_agg_df(self, table, match):
         '''
-        Function to get the information stored in the nested dictionary about the segment
+        Input: Efforts collection, Filter for the efforts to aggregate
+        Output: DataFrame of mean average_speed and effort_count per athlete-segment pair, ordered
+                like a groupby
         '''
-        # Specify which elements of the segment dictionary to keep
-        categories = ['average_grade', 'distance', 'elevation_low', 
-                      'elevation_high', 'maximum_grade']
+        predicted_speed = {'$avg': ['$athlete.speed', '$segment.speed']}
+        pipeline = [{'$match': match},
+                    {'$project': {'_id': 0, 'athlete_id': '$athlete.id', 
+                                  'segment_id': '$segment.id', 'speed': mongo_speed}},
+                    # Join each effort's athlete and segment statistics
+                    {'$lookup': {'from': 'athlete_speeds', 'localField': 'athlete_id',
+                                 'foreignField': '_id', 'as': 'athlete'}},
+                    {'$lookup': {'from': 'segment_speeds', 'localField': 'segment_id',
+                                 'foreignField': '_id', 'as': 'segment'}},
+                    {'$unwind': '$athlete'},
+                    {'$unwind': '$segment'},
+                    # Keep efforts within outlier_k segment speed stds of their predicted speed,
+                    # a missing std (single effort segments) keeps none like NaN does
+                    {'$project': {'athlete_id': 1, 'segment_id': 1, 'speed': 1,
+                                  'inlier': {'$lt': [{'$abs': {'$subtract': [predicted_speed, 
+                                                                             '$speed']}},
+                                                     {'$multiply': [self.outlier_k, 
+                                                                    '$segment.std']}]}}},
+                    {'$match': {'inlier': True}},
+                    {'$group': {'_id': {'athlete_id': '$athlete_id', 'segment_id': '$segment_id'},
+                                'average_speed': {'$avg': '$speed'}, 
+                                'effort_count': {'$sum': 1}}},
+                    {'$project': {'_id': 0, 'athlete_id': '$_id.athlete_id', 
+                                  'segment_id': '$_id.segment_id', 'average_speed': 1, 
+                                  'effort_count': 1}}]
 
-        # Make a new column in the df for each of the segment elements
-        for category in categories:
-            self.df['seg_{}'.format(category)] = self.df.segment.apply(lambda x: x[category])
+        columns = ['athlete_id', 'segment_id', 'average_speed', 'effort_count']
+        agg_df = pd.DataFrame(list(table.aggregate(pipeline, allowDiskUse=True)), columns=columns)
+        return agg_df.sort_values(['athlete_id', 'segment_id']).reset_index(drop=True)
+
+    def get_df_from_mongo_chunks(self, table, size=False):
+        '''
+        Function to stream the efforts collection chunk_size documents at a time, projecting only
+        the needed fields on the server and filling preallocated, compactly typed column arrays
+        Input: Efforts collection, Number of efforts to retrieve, False for all of them
+        Output: DataFrame of only the streamed columns from mongo database
+        '''
+        # Count the efforts first so every column can be allocated once at its final size
+        num_efforts = table.count_documents({}, limit=size) if size else table.count_documents({})
+        columns = {name: np.empty(num_efforts, dtype=dtype) 
+                   for name, dtype in streamed_column_dtypes.items()}
+
+        # Fill the columns one cursor batch at a time, capped at the count in case of new inserts
+        cursor = islice(table.find({}, mongo_projection, batch_size=self.chunk_size), num_efforts)
+        start = 0
+        for efforts in iter(lambda: list(islice(cursor, self.chunk_size)), []):
+            chunk = self.flatten_efforts(efforts)
+            stop = start + len(efforts)
+            for name, values in chunk.items():
+                columns[name][start:stop] = values
+            start = stop
+
+        return pd.DataFrame(columns, columns=sorted(streamed_column_dtypes)).iloc[:start]
+
+    def flatten_nested_columns(self):
+        '''
+        Function to pull every needed key out of the nested dictionaries, one sweep per dictionary
+        column rather than one python level apply per key
+        '''
+        # Nested dictionary columns still in the df, streamed DataFrames are already flattened
+        nested_columns = [column for column in ['athlete', 'segment', 'activity'] 
+                          if column in self.df.columns]
+
+        for nested in nested_columns:
+            # Flat column names and the keys they come from in this nested dictionary
+            fields = [(name, key) for name, column, key in nested_fields if column == nested]
+
+            # Build all of this dictionary's wanted keys at once from the list of dictionaries
+            flat = pd.DataFrame(self.df[nested].values.tolist(), 
+                                columns=[key for name, key in fields])
+
+            # Make a new column in the df for each of the keys
+            for name, key in fields:
+                self.df[name] = flat[key].values
 
     def make_date_col(self):
         '''
@@ -116,45 +656,34 @@ class EffortDfGetter(object):
                    'id', '_id', 'achievements', 'end_index', 'segment', 'athlete', 'start_date', 
                    'start_date_local', 'average_cadence', 'average_heartrate', 'activity']
         
-        # Drop all the useless columns
-        self.df.drop(columns, inplace=True, axis=1)
+        # Drop all the useless columns that are present, streamed DataFrames only have a few
+        self.df.drop([column for column in columns if column in self.df.columns], 
+                     inplace=True, axis=1)
 
     def remove_outliers(self):
         '''
         Function to remove athlete effort outliers, as measured by their naively calculated expected
         speed.
-        '''
-        # Averge speed per athlete
-        athlete_average_speed = self.df.groupby('athlete_id', as_index=False).average_speed.mean()
-
-        # Average speed and standard deviation per segment
-        segment_average_speed = self.df.groupby('segment_id').average_speed.mean().reset_index()
-        segment_speed_std = self.df.groupby('segment_id').average_speed.std().reset_index()
 
-        # Merge all those dfs together
-        df = pd.merge(self.df, athlete_average_speed, 
-                      on='athlete_id', 
-                      how='left', 
-                      suffixes=('', '_ath_mean'))
-
-        df = pd.merge(df, segment_average_speed, 
-                      on='segment_id', 
-                      how='left', 
-                      suffixes=('', '_seg_mean'))
-
-        df = pd.merge(df, segment_speed_std, 
-                      on='segment_id', 
-                      how='left', 
-                      suffixes=('', '_seg_std'))
+        Group statistics are computed with bincounts over integer group codes and broadcast back by
+        indexing, so no merged copies of the df are made
+        '''
+        speeds = self.df.average_speed.values.astype(np.float64)
 
-        # Make predicted speed column, average of athlete's average and segment's average
-        df.eval('predicted_speed = (average_speed_ath_mean + average_speed_seg_mean) / 2')
+        # Integer codes for each effort's athlete and segment
+        athlete_codes, athletes = pd.factorize(self.df.athlete_id)
+        segment_codes, segments = pd.factorize(self.df.segment_id)
 
-        # Inliers equal to only those efforts whoes average_speed are within 4 stds of predicted
-        inlier_df = df[np.abs(df.predicted_speed - df.average_speed) < 4 * df.average_speed_seg_std]
+        # Average speed per athlete and per segment
+        athlete_average_speed = group_means(speeds, athlete_codes, len(athletes))
+        segment_average_speed = group_means(speeds, segment_codes, len(segments))
 
-        # Set whole df to inliers without added columns
-        added_columns = ['average_speed_ath_mean', 'average_speed_seg_mean', 
-                         'average_speed_seg_std', 'predicted_speed']
-        self.df = inlier_df.drop(added_columns, axis=1)
+        # Predicted speed, average of athlete's average and segment's average
+        predicted_speeds = (athlete_average_speed[athlete_codes] + 
+                            segment_average_speed[segment_codes]) / 2
 
+        # Keep only the efforts the outlier rule calls inliers
+        rule = outlier_rules.get(self.outlier_rule, self.outlier_rule)
+        inliers = rule(speeds, predicted_speeds, segment_codes, len(segments), self.outlier_k)
+        # Own copy rather than a slice, so the id code columns can be added to it
+        self.df = self.df[inliers].copy()
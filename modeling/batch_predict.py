@@ -0,0 +1,231 @@
+import numpy as np
+import pandas as pd
+import create_model as cm
+from nmf import NMFRecommender
+
+# Columns of the top segment tables
+top_segment_columns = ['athlete_id', 'rank', 'segment_id', 'predicted_speed', 'relative_speed',
+                       'standing']
+
+def top_k_columns(values, k):
+    '''
+    Input:  2d array of values, number of top values wanted in each row
+    Output: 2d array of the column indices of each row's k largest values, largest first, equal
+            values in column order
+
+    Partially selects each row's top k before sorting, so only those k values are ever sorted.
+    Rows with ties at the cutoff are fully sorted instead, so the tie always goes to the lowest
+    columns
+    '''
+    if k >= values.shape[1]:
+        return np.argsort(-values, axis=1, kind='mergesort')
+    rows = np.arange(values.shape[0])[:, np.newaxis]
+    top_k = np.argpartition(values, values.shape[1] - k, axis=1)[:, -k:]
+    top_k = top_k[rows, np.lexsort((top_k, -values[rows, top_k]), axis=-1)]
+
+    tied = (values >= values[rows, top_k[:, -1:]]).sum(axis=1) > k
+    if tied.any():
+        top_k[tied] = np.argsort(-values[tied], axis=1, kind='mergesort')[:, :k]
+    return top_k
+
+def get_segment_speed_stats(agg_df, segment_ids, segment_id='segment_id',
+                            target='average_speed'):
+    '''
+    Input:  DataFrame of athlete-segment pairs and their average speeds, like the models are fit
+            on, array of segment ids, names of the segment and target columns
+    Output: Array of the mean, array of the standard deviation of the athletes' speeds on each
+            segment, NaN for segments with too few athletes
+    '''
+    stats = agg_df.groupby(segment_id)[target].agg(['mean', 'std']).reindex(segment_ids)
+    return stats['mean'].values, stats['std'].values
+
+def get_model_speed_stats(model):
+    '''
+    Input:  NMFRecommender fit on pairs
+    Output: Array of the mean, array of the standard deviation of the athletes' speeds on each of
+            the model's segments, from its pair totals
+    '''
+    means = model.pair_means().tocsc()
+    counts = np.diff(means.indptr).astype(np.float64)
+    sums = np.asarray(means.sum(axis=0)).ravel()
+    squares = np.asarray(means.multiply(means).sum(axis=0)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        segment_means = sums / counts
+        variances = (squares - counts * segment_means**2) / (counts - 1)
+    return segment_means, np.sqrt(np.maximum(variances, 0))
+
+class FactorScorer(object):
+    '''
+    Predicts athletes' speeds on every segment straight from a factorization's athlete and segment
+    factor matrices, with one matrix multiply per block of athletes instead of a table of pairs
+    '''
+    def __init__(self, athlete_factors, segment_factors, athlete_ids, segment_ids,
+                 segment_means=None, segment_stds=None, memory_limit=2**26):
+        '''
+        Input:  Array of athlete factors (athletes x factors), array of segment factors
+                (segments x factors), array of the athlete id of each row, array of the segment
+                id of each row, Arrays of the mean and standard deviation of the athletes'
+                observed speeds on each segment, needed for top segments, Most bytes of
+                predictions to hold at once
+        '''
+        self.athlete_factors = athlete_factors
+        self.segment_factors = segment_factors
+        self.athlete_ids = pd.Index(athlete_ids, name='athlete_id')
+        self.segment_ids = pd.Index(segment_ids, name='segment_id')
+
+        # Enough athletes per block to fill the memory limit, but always at least one
+        self.block_size = max(1, memory_limit // (8 * max(len(self.segment_ids), 1)))
+
+        # Strengths and weaknesses are where an athlete stands among the athletes who rode each
+        # segment, not against the average athlete's prediction, which with one factor is the
+        # same ratio on every segment
+        self.segment_means = segment_means
+        self.segment_stds = segment_stds
+
+        # Equal scores go to the lower segment id
+        self.segment_order = np.argsort(self.segment_ids.values, kind='mergesort')
+
+    @classmethod
+    def from_ratings(cls, athlete_ratings, segment_ratings, agg_df=None, **kwargs):
+        '''
+        Input:  DataFrame of athlete ratings, DataFrame of segment ratings, with one rating_*
+                column per latent feature and indexed by id, as from create_model's
+                get_latent_features, DataFrame of the pairs they were fit on for the segments'
+                speed stats, Keyword arguments for FactorScorer
+        Output: FactorScorer of the ratings
+        '''
+        columns = ['rating_{}'.format(i+1) for i in
+                   range(len([c for c in athlete_ratings.columns if c.startswith('rating_')]))]
+        if agg_df is not None:
+            kwargs['segment_means'], kwargs['segment_stds'] = get_segment_speed_stats(
+                agg_df, segment_ratings.index.values)
+        return cls(athlete_ratings[columns].values.astype(np.float64),
+                   segment_ratings[columns].values.astype(np.float64),
+                   athlete_ratings.index.values, segment_ratings.index.values, **kwargs)
+
+    @classmethod
+    def from_model(cls, model, agg_df=None, **kwargs):
+        '''
+        Input:  Fitted NMFRecommender or GraphLab model, DataFrame of the pairs it was fit on for
+                the segments' speed stats, which an NMFRecommender fit here already has,
+                Keyword arguments for FactorScorer
+        Output: FactorScorer of the model's factors
+        '''
+        if not isinstance(model, NMFRecommender):
+            athlete_ratings, segment_ratings = cm.get_clean_dfs_from_model(model,
+                                                                           model['num_factors'])
+            return cls.from_ratings(athlete_ratings, segment_ratings, agg_df, **kwargs)
+        if agg_df is not None:
+            kwargs['segment_means'], kwargs['segment_stds'] = get_segment_speed_stats(
+                agg_df, np.asarray(model.items), model.item_id, model.target)
+        elif model.pair_sums is not None:
+            kwargs['segment_means'], kwargs['segment_stds'] = get_model_speed_stats(model)
+        return cls(model.nmf.row_factors, model.nmf.column_factors,
+                   np.asarray(model.users), np.asarray(model.items), **kwargs)
+
+    def get_positions(self, athlete_ids=None):
+        '''
+        Input:  Array of athlete ids, None for every athlete
+        Output: Array of their rows in the factors, -1 for athletes the model never saw
+        '''
+        if athlete_ids is None:
+            return np.arange(len(self.athlete_ids))
+        return self.athlete_ids.get_indexer(athlete_ids)
+
+    def predict_block(self, positions):
+        '''
+        Input:  Array of athlete rows in the factors, -1 for unknown athletes
+        Output: 2d array of the athletes' predicted speeds on every segment, NaN rows for unknown
+                athletes
+        '''
+        known = positions >= 0
+        if known.all():
+            return self.athlete_factors[positions].dot(self.segment_factors.T)
+        predictions = np.empty((len(positions), len(self.segment_ids)))
+        predictions.fill(np.nan)
+        predictions[known] = self.athlete_factors[positions[known]].dot(self.segment_factors.T)
+        return predictions
+
+    def iter_predictions(self, athlete_ids=None):
+        '''
+        Input:  Array of athlete ids, None for every athlete
+        Output: Generator of (array of a block's athlete ids, 2d array of their predicted speeds
+                on every segment)
+
+        Only one block of predictions is held at a time, so scoring every athlete against every
+        segment stays within the memory limit
+        '''
+        positions = self.get_positions(athlete_ids)
+        ids = self.athlete_ids.values if athlete_ids is None else np.asarray(athlete_ids)
+        for start in range(0, len(positions), self.block_size):
+            stop = start + self.block_size
+            yield ids[start:stop], self.predict_block(positions[start:stop])
+
+    def predict(self, athlete_ids):
+        '''
+        Input:  Array of athlete ids
+        Output: DataFrame of their predicted speeds indexed by athlete_id, with a column per
+                segment_id, NaN for athletes the model never saw
+        '''
+        predictions = np.vstack([block for ids, block in self.iter_predictions(athlete_ids)] or
+                                [np.empty((0, len(self.segment_ids)))])
+        return pd.DataFrame(predictions, index=pd.Index(athlete_ids, name='athlete_id'),
+                            columns=self.segment_ids)
+
+    def iter_top_segments(self, n=10, weakest=False, athlete_ids=None):
+        '''
+        Input:  Number of segments per athlete, True for their weakest segments rather than their
+                strongest, Array of athlete ids, None for every athlete
+        Output: Generator of DataFrames of a block's athlete_id, rank, segment_id,
+                predicted_speed, relative_speed and standing, n rows per known athlete
+
+        standing is how many standard deviations the athlete's predicted speed is above the mean
+        of the athletes who rode the segment, so an athlete's strongest segments are where they
+        are predicted to place the highest. relative_speed is their predicted speed over that mean
+        '''
+        if self.segment_means is None or self.segment_stds is None:
+            raise ValueError('Top segments need the segments\' observed speed stats, pass '
+                             'segment_means and segment_stds or the pairs the model was fit on')
+        n = min(n, len(self.segment_ids))
+        for ids, predictions in self.iter_predictions(athlete_ids):
+            known = ~np.isnan(predictions[:, 0]) if n else np.zeros(len(ids), dtype=bool)
+            ids, predictions = ids[known], predictions[known]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                relative = predictions / self.segment_means
+                standing = (predictions - self.segment_means) / self.segment_stds
+
+            # Segments without a spread of athletes can not be compared, they rank last
+            scores = -standing if weakest else standing.copy()
+            scores[~np.isfinite(scores)] = -np.inf
+            top = self.segment_order[top_k_columns(scores[:, self.segment_order], n)]
+
+            rows = np.arange(len(ids))[:, np.newaxis]
+            yield pd.DataFrame({'athlete_id': np.repeat(ids, n),
+                                'rank': np.tile(np.arange(1, n + 1), len(ids)),
+                                'segment_id': self.segment_ids.values[top].ravel(),
+                                'predicted_speed': predictions[rows, top].ravel(),
+                                'relative_speed': relative[rows, top].ravel(),
+                                'standing': standing[rows, top].ravel()},
+                               columns=top_segment_columns)
+
+    def top_segments(self, n=10, weakest=False, athlete_ids=None):
+        '''
+        Input:  Number of segments per athlete, True for their weakest segments rather than their
+                strongest, Array of athlete ids, None for every athlete
+        Output: DataFrame of athlete_id, rank, segment_id, predicted_speed, relative_speed and
+                standing, n rows per known athlete
+        '''
+        blocks = list(self.iter_top_segments(n, weakest, athlete_ids))
+        if not blocks:
+            return pd.DataFrame(columns=top_segment_columns)
+        return pd.concat(blocks, ignore_index=True)
+
+def get_scorers(models, aggs=None, **kwargs):
+    '''
+    Input:  Dictionary of subset name, fitted model, Dictionary of subset name, DataFrame of the
+            pairs its model was fit on (e.g. from create_model.get_agg_dfs_for_model), Keyword
+            arguments for FactorScorer
+    Output: Dictionary of subset name, FactorScorer of its model
+    '''
+    return {name: FactorScorer.from_model(model, (aggs or {}).get(name), **kwargs)
+            for name, model in models.items()}
@@ -0,0 +1,63 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+import create_model as cm
+from ranking import Leaderboards
+
+def make_speeds(num_athletes, num_segments, num_efforts, random_state=0):
+    '''
+    Input: Number of athletes, number of segments, number of efforts, seed
+    Output: DataFrame of random efforts with athlete_id, segment_id, average_speed and 
+            seg_average_grade, like the one Leaderboards is built from
+    '''
+    random = np.random.RandomState(random_state)
+    segment_grades = random.uniform(-10, 10, num_segments)
+    segment_ids = random.randint(0, num_segments, num_efforts)
+    return pd.DataFrame({'athlete_id': random.randint(0, num_athletes, num_efforts),
+                         'segment_id': segment_ids,
+                         'average_speed': random.uniform(1, 15, num_efforts),
+                         'seg_average_grade': segment_grades[segment_ids]})
+
+def add_grade_subsets(num_columns):
+    '''
+    Input: Number of rating columns wanted
+    Output: List of num_columns subset names, the ones in subset_querys_dict followed by grade 
+            threshold subsets added to it to make up the number
+    '''
+    names = ['total', 'uphill', 'downhill']
+    for i in range(num_columns - len(names)):
+        name = 'steeper_than_{}'.format(i)
+        cm.subset_querys_dict[name] = 'seg_average_grade > {}'.format(i % 10)
+        names.append(name)
+    return names[:num_columns]
+
+def time_boards(speeds, num_columns, random_state=0):
+    '''
+    Input: DataFrame of efforts, number of rating columns, seed
+    Output: Seconds to build every athlete leaderboard from a fresh Leaderboards
+    '''
+    names = add_grade_subsets(num_columns)
+    athletes = speeds.athlete_id.unique()
+    random = np.random.RandomState(random_state)
+    ratings = pd.DataFrame(random.uniform(0, 5, (len(athletes), num_columns)),
+                           index=pd.Index(athletes, name='athlete_id'),
+                           columns=['{}_rating'.format(name) for name in names])
+
+    # Like the models, only rate athletes with efforts in each subset
+    effort_counts = Leaderboards(speeds).get_speed_stats('athlete').ix[athletes]
+    for name in names:
+        ratings.loc[effort_counts['{}_effort_count'.format(name)].values == 0, 
+                    '{}_rating'.format(name)] = np.nan
+
+    t = time.time()
+    Leaderboards(speeds).get('athlete', ratings)
+    return time.time() - t
+
+if __name__ == '__main__':
+    num_efforts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    speeds = make_speeds(num_efforts // 20, 100, num_efforts)
+
+    print '{:>8} {:>10}'.format('columns', 'seconds')
+    for num_columns in [1, 3, 6, 12, 24]:
+        print '{:>8} {:>10.2f}'.format(num_columns, time_boards(speeds, num_columns))
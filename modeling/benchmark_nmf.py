@@ -0,0 +1,49 @@
+import sys
+import time
+import numpy as np
+import scipy.sparse as sp
+from nmf import SparseNMF
+
+def make_low_rank_matrix(num_rows, num_columns, density, num_factors, random_state=0):
+    '''
+    Input: Number of rows (athletes), number of columns (segments), fraction of entries observed,
+           rank of the underlying factorization, seed
+    Output: Sparse matrix of noisy observations of a non-negative low rank matrix
+    '''
+    random = np.random.RandomState(random_state)
+    row_factors = random.uniform(.5, 2, (num_rows, num_factors))
+    column_factors = random.uniform(.5, 2, (num_columns, num_factors))
+
+    # Observe a random set of distinct entries
+    num_observed = int(num_rows * num_columns * density)
+    entries = np.unique(random.randint(0, num_rows * num_columns, num_observed))
+    rows, columns = entries // num_columns, entries % num_columns
+
+    values = np.einsum('ij,ij->i', row_factors[rows], column_factors[columns])
+    values *= random.uniform(.95, 1.05, len(entries))
+    return sp.csr_matrix((values, (rows, columns)), shape=(num_rows, num_columns))
+
+def time_to_converge(matrix, solver, num_factors, tol=1e-4):
+    '''
+    Input: Sparse matrix of observations, solver name, number of latent features, tolerance
+    Output: Seconds to converge, iterations used, final training RMSE
+    '''
+    nmf = SparseNMF(num_factors=num_factors, solver=solver, max_iterations=500, tol=tol,
+                    random_state=0)
+    t = time.time()
+    nmf.fit(matrix)
+    return time.time() - t, nmf.iterations, nmf.rmse_history[-1]
+
+if __name__ == '__main__':
+    num_factors = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    sizes = [(1000, 20), (10000, 100), (100000, 100), (500000, 1000)]
+
+    print '{:>8} {:>8} {:>10} {:>6} {:>10} {:>6} {:>8}'.format('athletes', 'segments', 'observed',
+                                                            'solver', 'seconds', 'iters', 'rmse')
+    for num_rows, num_columns in sizes:
+        matrix = make_low_rank_matrix(num_rows, num_columns, 5. / num_columns, num_factors)
+        for solver in ['mu', 'hals']:
+            seconds, iterations, rmse = time_to_converge(matrix, solver, num_factors)
+            print '{:>8} {:>8} {:>10} {:>6} {:>10.2f} {:>6} {:>8.4f}'.format(num_rows, num_columns,
+                                                                          matrix.nnz, solver,
+                                                                          seconds, iterations, rmse)
@@ -1,25 +1,20 @@
-import graphlab as gl
+import numpy as np
 import pandas as pd
+from nmf import NMFRecommender
+from effort_matrix import EffortMatrix
+from fork_pool import fork_map, shared
+
+# GraphLab is proprietary and only needed for the 'graphlab' backend
+try:
+    import graphlab as gl
+except ImportError:
+    gl = None
 
 # Types of segments to classify
 subset_querys_dict = {'total': None, 
                       'uphill': 'seg_average_grade > 0', 
                       'downhill': 'seg_average_grade < 0'}
     
-def get_agg_sf(df):
-    '''
-    Input: DataFrame with data to create model from
-    Output: SFrame of target data aggregated over athlete-segment pairs
-    '''
-    # Columns that are going to be used to make model
-    columns_to_keep = ['segment_id', 'athlete_id', 'average_speed']
-
-    # Take mean over aggregated athlete-segment pairs, move those columns out of index
-    agg_df = df.groupby(['athlete_id', 'segment_id']).mean().reset_index()
-
-    # Return an SFrame of those aggregated target column, average_speed
-    return gl.SFrame(agg_df[columns_to_keep])
-
 def make_cleaner_dfs(dfs, num_features):
     '''
     Input: List of DataFrames with latent features in single list, how many latent features in list
@@ -64,7 +59,35 @@ def get_clean_dfs_from_model(model, num_features):
 
     return cleaner_athlete_df, cleaner_segment_df
 
-def get_latent_features(agg_sf, number_latent_features):
+def get_latent_features(agg, number_latent_features, backend='native', **nmf_params):
+    '''
+    Input: SFrame (graphlab backend) or DataFrame (native backend) of data aggregated over 
+           athlete-segment pairs to be modeled, Number of latent features in unitary matricies,
+           Which factorization backend to use, 'native' or 'graphlab', SparseNMF settings
+           (native backend only)
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Fitted model
+    '''
+    if backend == 'native':
+        return get_native_latent_features(agg, number_latent_features, **nmf_params)
+    return get_graphlab_latent_features(agg, number_latent_features)
+
+def get_native_latent_features(agg_df, number_latent_features, **nmf_params):
+    '''
+    Input: DataFrame of data aggregated over athlete-segment pairs to be modeled,
+           Number of latent features in unitary matricies, SparseNMF settings to override the
+           defaults, e.g. regularization, max_iterations or solver
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Fitted NMFRecommender
+    '''
+    # Make and fit the sparse NMF model to agg_df data, default settings match the GraphLab model
+    params = dict({'regularization': 0, 'max_iterations': 100}, **nmf_params)
+    model = NMFRecommender(user_id='athlete_id', item_id='segment_id', target='average_speed',
+                           num_factors=number_latent_features, **params).fit(agg_df)
+
+    athlete_ratings, segment_ratings = model.get_ratings()
+
+    return athlete_ratings, segment_ratings, model
+
+def get_graphlab_latent_features(agg_sf, number_latent_features):
     '''
     Input: SFrame of data aggregated over athlete-segment pairs to be modeled,
            Number of latent features in unitary matricies
@@ -99,24 +122,160 @@ def get_sfs_for_model(df, segment_type_names):
            to return
     Output: Dictionary of subset name, corresponding subsetted sf pairs
     '''
-    # Get subsetted dfs for model dict
-    dfs_for_model = get_dfs_for_model(df, segment_type_names)
-    return {name: get_agg_sf(df) for name, df in dfs_for_model.items()}
+    # Get aggregated subsets for model dict
+    aggs_for_model = get_agg_dfs_for_model(df, segment_type_names)
+    return {name: gl.SFrame(agg[['segment_id', 'athlete_id', 'average_speed']]) 
+            for name, agg in aggs_for_model.items()}
+
+def get_agg_dfs_for_model(df, segment_type_names):
+    '''
+    Input: Full DataFrame to be subsetted and aggregated for modeling, list of subset types to 
+           return
+    Output: Dictionary of subset name, corresponding aggregated subset df pairs
+    '''
+    return get_matrix_aggs_for_model(EffortMatrix(df), segment_type_names)
+
+def get_matrix_aggs_for_model(effort_matrix, segment_type_names):
+    '''
+    Input: EffortMatrix of every effort, list of subset types to return
+    Output: Dictionary of subset name, corresponding aggregated subset df pairs
+
+    The efforts are aggregated once into the matrix, each subset is a view of its segment columns
+    '''
+    subsets = {name: effort_matrix.subset(subset_querys_dict[name]) for name in segment_type_names}
+
+    # Athletes with no efforts in a subset have empty rows there, they are left out of its pairs
+    return {name: subset.get_agg_df() for name, subset in subsets.items()}
+
+def get_mongo_agg_dfs_for_model(df_getter, segment_type_names, start_date=None, end_date=None):
+    '''
+    Input: EffortDfGetter reading from mongo, list of subset types to return, Optional dates to
+           only aggregate efforts started after start_date and on or before end_date
+    Output: Dictionary of subset name, corresponding aggregated subset df pairs
+
+    Same aggregates as get_agg_dfs_for_model, built by aggregation pipelines in the database so
+    the raw efforts never leave it
+    '''
+    querys = {name: subset_querys_dict[name] for name in segment_type_names}
+    return df_getter.get_agg_dfs_from_mongo(querys, start_date, end_date)
+
+def predict_agg(model, agg_df):
+    '''
+    Input: Fitted NMFRecommender or GraphLab model, DataFrame of athlete-segment pairs
+    Output: Array of predicted average speeds for the pairs
+    '''
+    if isinstance(model, NMFRecommender):
+        return model.predict(agg_df)
+    return np.array(model.predict(gl.SFrame(agg_df[['segment_id', 'athlete_id']])))
+
+def fit_subset_model(args):
+    '''
+    Input: Tuple of subset name, number of latent features, dictionary of SparseNMF settings
+    Output: Tuple of subset name, (athlete_ratings, segment_ratings, fitted NMFRecommender)
+
+    Worker for parallel training, takes its subset of the shared EffortMatrix inherited from the
+    parent
+    '''
+    name, number_latent_features, nmf_params = args
+    agg_df = get_matrix_aggs_for_model(shared['matrix'], [name])[name]
+    return name, get_native_latent_features(agg_df, number_latent_features, **nmf_params)
+
+def get_parallel_latent_features(df, number_latent_features, segment_type_names, n_jobs,
+                                 **nmf_params):
+    '''
+    Input: DataFrame with observations for model to be trained on, 
+           Number of latent features for model to decompose data into, list of subset types,
+           Number of worker processes, -1 for one per cpu, SparseNMF settings
+    Output: Dictionary of subset name, (athlete_ratings, segment_ratings, model) pairs
+
+    Fits every subset at the same time in a process pool, so retraining takes about as long as 
+    the slowest subset
+    '''
+    rankings = fork_map(fit_subset_model, [(name, number_latent_features, nmf_params) 
+                                           for name in segment_type_names],
+                        {'matrix': EffortMatrix(df)}, n_jobs)
+    return dict(rankings)
 
 def df_to_latent_features(df, number_latent_features=1, 
-                          segment_type_names = ['total', 'uphill', 'downhill']):
+                          segment_type_names = ['total', 'uphill', 'downhill'],
+                          backend='native', n_jobs=1, **nmf_params):
     '''
     Input: DataFrame with observations for model to be trained on, 
-           Number of latent features for model to decompose data into
-    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Fitted GraphLab model
+           Number of latent features for model to decompose data into,
+           Which factorization backend to use, 'native' or 'graphlab',
+           Number of subsets to fit at the same time, -1 for one per cpu (native backend only),
+           SparseNMF settings, e.g. regularization=0, max_iterations=100 (native backend only)
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Fitted models
     '''
-    # Get all the SFrames for the subsets of the df corresponding with types list
-    sfs_for_model = get_sfs_for_model(df, segment_type_names)
+    if (n_jobs != 1 or nmf_params) and backend != 'native':
+        raise ValueError('Parallel training and model settings are only supported by the native '
+                         'backend')
 
     # Get all ratings dfs and models in a dictionary
-    rankings_dict = {name: get_latent_features(sf, number_latent_features) 
-                     for name, sf in sfs_for_model.items()}
+    if n_jobs != 1:
+        rankings_dict = get_parallel_latent_features(df, number_latent_features, 
+                                                     segment_type_names, n_jobs, **nmf_params)
+    else:
+        # Get all the aggregates for the subsets of the df corresponding with types list
+        if backend == 'native':
+            aggs_for_model = get_agg_dfs_for_model(df, segment_type_names)
+        else:
+            aggs_for_model = get_sfs_for_model(df, segment_type_names)
+
+        rankings_dict = {name: get_latent_features(agg, number_latent_features, backend, 
+                                                   **nmf_params) 
+                         for name, agg in aggs_for_model.items()}
     
+    return combine_rankings(rankings_dict, segment_type_names)
+
+def mongo_to_latent_features(df_getter, number_latent_features=1, 
+                             segment_type_names = ['total', 'uphill', 'downhill'],
+                             backend='native', end_date=None):
+    '''
+    Input: EffortDfGetter reading from mongo, Number of latent features for model to decompose 
+           data into, list of subset types, Which factorization backend to use, 'native' or 
+           'graphlab', Optional date to only train on efforts started on or before
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Fitted models
+
+    df_to_latent_features for efforts aggregated in the database instead of pulled into a df
+    '''
+    aggs_for_model = get_mongo_agg_dfs_for_model(df_getter, segment_type_names, 
+                                                 end_date=end_date)
+    if backend != 'native':
+        aggs_for_model = {name: gl.SFrame(agg[['segment_id', 'athlete_id', 'average_speed']])
+                          for name, agg in aggs_for_model.items()}
+
+    rankings_dict = {name: get_latent_features(agg, number_latent_features, backend) 
+                     for name, agg in aggs_for_model.items()}
+
+    return combine_rankings(rankings_dict, segment_type_names)
+
+def update_latent_features(models, delta_df, 
+                           segment_type_names = ['total', 'uphill', 'downhill'],
+                           max_iterations=None):
+    '''
+    Input: Dictionary of fitted NMFRecommender models by subset name, DataFrame of newly ingested
+           efforts, list of subset types to update, Maximum number of warm started iterations
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Updated models
+
+    Updates each subset model in place with the new efforts in its subset, refitting only the
+    athletes and segments those efforts touch rather than retraining from scratch
+    '''
+    dfs_for_update = get_dfs_for_model(delta_df, segment_type_names)
+
+    rankings_dict = {}
+    for name, df in dfs_for_update.items():
+        model = models[name].update(df, max_iterations)
+        rankings_dict[name] = model.get_ratings() + (model,)
+
+    return combine_rankings(rankings_dict, segment_type_names)
+
+def combine_rankings(rankings_dict, segment_type_names):
+    '''
+    Input: Dictionary of subset name, (athlete_ratings, segment_ratings, model) pairs, list of 
+           subset types in column order
+    Output: DataFrame of athlete_ratings, DataFrame of segment_ratings, Dictionary of models
+    '''
     # Make aggregate rankings dfs by concatenating rankings from all models together
     athlete_ratings = pd.concat([pd.Series(rankings_dict[name][0].rating_1, 
                                            name='{}_rating'.format(name))
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from nmf import get_pair_means
+
+def get_codes(df, name):
+    '''
+    Input: DataFrame of efforts, athlete or segment
+    Output: Array of each effort's position, array of the id at each position, array of the id
+            dictionary code at each position (None when the efforts have no code column)
+
+    Positions follow the id dictionary's codes when there are any, otherwise first appearance
+    '''
+    ids = df['{}_id'.format(name)].values
+    code_column = '{}_code'.format(name)
+    if code_column not in df:
+        positions, unique_ids = pd.factorize(ids)
+        return positions, np.asarray(unique_ids), None
+
+    codes, first, positions = np.unique(df[code_column].values, return_index=True,
+                                        return_inverse=True)
+    return positions, ids[first], codes
+
+class EffortMatrix(object):
+    '''
+    Athlete x segment matrices of every pair's summed speed and effort count, built in one pass
+    over the efforts. Segment columns are ordered by grade, so each grade subset is a contiguous
+    block of columns and its matrices are views sharing the full matrices' arrays
+    '''
+    def __init__(self, df):
+        '''
+        Input: DataFrame of efforts with athlete_id, segment_id, average_speed and
+               seg_average_grade columns, and optionally athlete_code and segment_code
+        '''
+        rows, self.athlete_ids, self.athlete_codes = get_codes(df, 'athlete')
+        columns, segment_ids, segment_codes = get_codes(df, 'segment')
+
+        # Order the segment columns by grade
+        grades = np.empty(len(segment_ids), dtype=np.float64)
+        grades[columns] = df.seg_average_grade.values
+        order = np.argsort(grades, kind='mergesort')
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+
+        self.segment_ids = segment_ids[order]
+        self.segment_codes = segment_codes[order] if segment_codes is not None else None
+        self.segments = pd.DataFrame({'segment_id': self.segment_ids,
+                                      'seg_average_grade': grades[order]})
+
+        # Repeated pairs are summed when converting to csc, which gives the totals
+        shape = (len(self.athlete_ids), len(self.segment_ids))
+        coordinates = (rows, position[columns])
+        self.sums = sp.coo_matrix((df.average_speed.values.astype(np.float64), coordinates),
+                                  shape=shape).tocsc()
+        self.counts = sp.coo_matrix((np.ones(len(df)), coordinates), shape=shape).tocsc()
+
+    @property
+    def shape(self):
+        return self.sums.shape
+
+    def subset(self, query):
+        '''
+        Input: Query string on the segments' columns (segment_id, seg_average_grade), None for
+               every segment
+        Output: EffortMatrix of just the matching segment columns, with the same athlete rows
+
+        A contiguous block of columns, as every grade range is, shares this matrix's arrays
+        '''
+        if not query:
+            return self
+        columns = np.flatnonzero(self.segments.eval(query).values)
+
+        subset = EffortMatrix.__new__(EffortMatrix)
+        subset.athlete_ids, subset.athlete_codes = self.athlete_ids, self.athlete_codes
+        subset.segment_ids = self.segment_ids[columns]
+        subset.segment_codes = self.segment_codes[columns] if self.segment_codes is not None \
+                               else None
+        subset.segments = self.segments.iloc[columns].reset_index(drop=True)
+        if len(columns) and columns[-1] - columns[0] + 1 == len(columns):
+            subset.sums = self.column_block(self.sums, columns[0], columns[-1] + 1)
+            subset.counts = self.column_block(self.counts, columns[0], columns[-1] + 1)
+        else:
+            subset.sums, subset.counts = self.sums[:, columns], self.counts[:, columns]
+        return subset
+
+    def column_block(self, matrix, start, stop):
+        '''
+        Input: Sparse csc matrix, first column, column after the last
+        Output: Sparse csc matrix of the columns, whose data and indices are views of matrix's
+        '''
+        indptr = matrix.indptr[start:stop + 1]
+        entries = slice(indptr[0], indptr[-1])
+
+        # Set the arrays directly, the constructor copies views of much larger arrays
+        block = sp.csc_matrix((matrix.shape[0], stop - start), dtype=matrix.dtype)
+        block.data, block.indices = matrix.data[entries], matrix.indices[entries]
+        block.indptr = indptr - indptr[0]
+        return block
+
+    def pair_means(self):
+        '''
+        Output: Sparse csc matrix of each pair's average speed
+        '''
+        return get_pair_means(self.sums, self.counts)
+
+    def get_agg_df(self):
+        '''
+        Output: DataFrame of average_speed and effort_count per athlete-segment pair, with the
+                pairs' codes when the matrix has them
+        '''
+        means, counts = self.pair_means().tocsr().tocoo(), self.counts.tocsr().tocoo()
+        agg_df = pd.DataFrame({'athlete_id': self.athlete_ids[means.row],
+                               'segment_id': self.segment_ids[means.col]},
+                              columns=['athlete_id', 'segment_id'])
+        if self.athlete_codes is not None and self.segment_codes is not None:
+            agg_df['athlete_code'] = self.athlete_codes[means.row]
+            agg_df['segment_code'] = self.segment_codes[means.col]
+        agg_df['average_speed'] = means.data
+        agg_df['effort_count'] = counts.data.astype(np.int64)
+        return agg_df
+
+    def get_totals(self, board_type, query=None):
+        '''
+        Input: Type of board, athlete or segment, Query string on the segments' columns to only
+               total that subset's efforts, None for all of them
+        Output: Array of every athlete/segment id, array of their summed speeds, array of their
+                effort counts
+        '''
+        if board_type == 'athlete':
+            subset = self.subset(query)
+            sums, counts = subset.sums.sum(axis=1), subset.counts.sum(axis=1)
+            ids = self.athlete_ids
+        else:
+            sums, counts = self.sums.sum(axis=0), self.counts.sum(axis=0)
+            ids = self.segment_ids
+        sums, counts = np.asarray(sums).ravel(), np.asarray(counts).ravel().astype(np.int64)
+
+        # Segments outside the subset have no efforts in it
+        if board_type != 'athlete' and query:
+            outside = ~self.segments.eval(query).values
+            sums[outside], counts[outside] = 0, 0
+        return ids, sums, counts
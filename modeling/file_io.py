@@ -0,0 +1,49 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Input: Path of the file to write, mode to open it with, 'w' or 'wb'
+    Output: Context manager giving the open file
+
+    Writes next to the final file then renames over it, so readers never see a half written file.
+    If the write fails the temporary file is removed and path is left as it was
+    '''
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextmanager
+def atomic_directory(path):
+    '''
+    Input: Path of the directory to write
+    Output: Context manager giving the path of a temporary directory to write into
+
+    The temporary directory is renamed into place once the block finishes, replacing any directory
+    already at path. The old one is moved aside rather than deleted first, so path is only
+    briefly missing
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    if os.path.exists(path):
+        os.rename(path, path + '.old')
+        os.rename(tmp_path, path)
+        shutil.rmtree(path + '.old')
+    else:
+        os.rename(tmp_path, path)
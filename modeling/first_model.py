@@ -3,12 +3,15 @@ sys.path.append('../eda')
 from strava_db import EffortDfGetter
 import validate_model as vm
 import create_model as cm
+import model_artifact as ma
 
 def get_df():
-    df_getter = EffortDfGetter(origin='json')
+    df_getter = EffortDfGetter(origin='json', cache=True)
     return df_getter.get()
 
 if __name__ == '__main__':
     df = get_df()
     training_df, testing_df = vm.split_efforts(df)
     athlete_ratings, segment_ratings, models = cm.df_to_latent_features(training_df)
+    metadata = ma.get_training_metadata(training_df, number_latent_features=1)
+    ma.save_model_artifact(models, '../data/models/nmf', metadata)
@@ -0,0 +1,42 @@
+import sys
+import multiprocessing as mp
+
+# Objects the parent shares with the workers of the running fork_map, set before the pool forks so
+# the workers inherit them copy-on-write instead of each being sent a pickled copy
+shared = {}
+
+def get_start_method():
+    '''
+    Output: Name of the start method new worker processes use
+    '''
+    if hasattr(mp, 'get_start_method'):
+        return mp.get_start_method()
+    return 'spawn' if sys.platform == 'win32' else 'fork'
+
+def fork_map(function, tasks, shared_objects, processes=-1):
+    '''
+    Input: Worker function taking one task, List of tasks, Dictionary of name, object the workers
+           read from fork_pool.shared, Number of worker processes, -1 for one per cpu, 1 to run
+           every task in this process
+    Output: List of the function's results, in task order
+
+    Requires the fork start method, workers started any other way would import this module
+    afresh and find shared empty, so that raises ValueError instead
+    '''
+    processes = mp.cpu_count() if processes == -1 else processes
+    if processes != 1 and get_start_method() != 'fork':
+        raise ValueError('fork_map needs the fork start method to share objects with its '
+                         'workers, got {}, use processes=1 instead'.format(get_start_method()))
+
+    shared.update(shared_objects)
+    try:
+        if processes == 1:
+            return [function(task) for task in tasks]
+        pool = mp.Pool(max(1, min(processes, len(tasks))))
+        try:
+            return pool.map(function, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shared.clear()
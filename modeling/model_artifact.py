@@ -0,0 +1,160 @@
+import os
+import json
+import datetime
+import numpy as np
+import pandas as pd
+import create_model as cm
+from nmf import NMFRecommender
+from batch_predict import FactorScorer
+from file_io import atomic_directory
+
+# Version of the artifact layout, bumped whenever the manifest or the array files change
+artifact_version = 1
+
+# Dtype of every array an artifact stores, fixed so each one can be memory-mapped, the lookups are
+# only stored for models fit with id codes, the segment speed stats only when they are known
+array_dtypes = {'athlete_factors': np.float64, 'segment_factors': np.float64,
+                'athlete_ids': np.int64, 'segment_ids': np.int64,
+                'athlete_lookup': np.int32, 'segment_lookup': np.int32,
+                'segment_means': np.float64, 'segment_stds': np.float64}
+
+def get_model_arrays(model, agg_df=None):
+    '''
+    Input: Fitted NMFRecommender or GraphLab model, DataFrame of the pairs it was fit on for the
+           segments' speed stats, which an NMFRecommender fit here already has
+    Output: Dictionary of array name, array of the model's factors, ids, code lookups and segment
+            speed stats
+    '''
+    scorer = FactorScorer.from_model(model, agg_df)
+    arrays = {'athlete_factors': scorer.athlete_factors,
+              'segment_factors': scorer.segment_factors,
+              'athlete_ids': scorer.athlete_ids.values, 'segment_ids': scorer.segment_ids.values}
+    if scorer.segment_means is not None:
+        arrays.update({'segment_means': scorer.segment_means,
+                       'segment_stds': scorer.segment_stds})
+    if (isinstance(model, NMFRecommender) and model.user_lookup is not None and 
+            model.item_lookup is not None):
+        arrays.update({'athlete_lookup': model.user_lookup, 'segment_lookup': model.item_lookup})
+    return {name: np.ascontiguousarray(array, dtype=array_dtypes[name])
+            for name, array in arrays.items()}
+
+def get_training_metadata(training_df, **settings):
+    '''
+    Input: DataFrame of the efforts the models were trained on, Training settings to record, e.g.
+           number_latent_features or SparseNMF settings
+    Output: Dictionary of the training data's size and date range and the settings, json
+            serializable
+    '''
+    return {'efforts': int(len(training_df)),
+            'athletes': int(training_df.athlete_id.nunique()),
+            'segments': int(training_df.segment_id.nunique()),
+            'start_date': str(training_df.date.min()) if len(training_df) else None,
+            'end_date': str(training_df.date.max()) if len(training_df) else None,
+            'settings': settings}
+
+def save_model_artifact(models, path, metadata=None, subset_querys=cm.subset_querys_dict,
+                        aggs=None):
+    '''
+    Input: Dictionary of subset name, fitted model, Directory to store the artifact in, Dictionary
+           of json serializable training metadata (e.g. from get_training_metadata), Dictionary of
+           subset name, query string defining the subset, Dictionary of subset name, DataFrame of
+           the pairs its model was fit on, needed for the speed stats of GraphLab models
+    Output: None
+
+    Writes manifest.json and one .npy file per array as an atomic directory, so readers never see
+    a partly written artifact. An artifact already at path is replaced
+    '''
+    with atomic_directory(path) as tmp_path:
+        subsets = {}
+        for name, model in models.items():
+            arrays = get_model_arrays(model, (aggs or {}).get(name))
+            files = {}
+            for array_name, array in sorted(arrays.items()):
+                files[array_name] = '{}_{}.npy'.format(name, array_name)
+                np.save(os.path.join(tmp_path, files[array_name]), array)
+            subsets[name] = {'query': subset_querys.get(name),
+                             'num_factors': arrays['athlete_factors'].shape[1],
+                             'athletes': len(arrays['athlete_ids']),
+                             'segments': len(arrays['segment_ids']),
+                             'files': files}
+
+        manifest = {'version': artifact_version,
+                    'created': datetime.datetime.utcnow().isoformat(),
+                    'subsets': subsets,
+                    'metadata': metadata or {}}
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+class ModelArtifact(object):
+    '''
+    Model artifact opened from disk. Its arrays are memory-mapped read only, so opening one only
+    reads the manifest, and processes opening the same artifact share its pages in the OS cache
+    rather than each loading a copy
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        '''
+        Input: Directory of an artifact stored with save_model_artifact, numpy mmap_mode to open
+               the arrays with, None to read them into memory
+        '''
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] > artifact_version:
+            raise ValueError('Model artifact version {} is newer than the supported version {}'
+                             .format(self.manifest['version'], artifact_version))
+
+        self.metadata = self.manifest['metadata']
+        self.subset_querys = {name: subset['query']
+                              for name, subset in self.manifest['subsets'].items()}
+        self.arrays = {name: {array_name: np.load(os.path.join(path, file_name),
+                                                  mmap_mode=mmap_mode)
+                              for array_name, file_name in subset['files'].items()}
+                       for name, subset in self.manifest['subsets'].items()}
+
+    @property
+    def names(self):
+        return sorted(self.arrays)
+
+    def get_model(self, name):
+        '''
+        Input: Subset name
+        Output: NMFRecommender of the subset's stored factors, for predicting and ratings
+
+        The recommender has no pair totals, so it can predict but its update raises ValueError,
+        new efforts need a refit
+        '''
+        arrays = self.arrays[name]
+        model = NMFRecommender(num_factors=self.manifest['subsets'][name]['num_factors'])
+        model.users, model.items = pd.Index(arrays['athlete_ids']), pd.Index(arrays['segment_ids'])
+        model.user_lookup = arrays.get('athlete_lookup')
+        model.item_lookup = arrays.get('segment_lookup')
+
+        # Point the factorization at the mapped factors rather than fitting it
+        model.nmf.row_factors = arrays['athlete_factors']
+        model.nmf.column_factors = arrays['segment_factors']
+        return model
+
+    def get_models(self):
+        '''
+        Output: Dictionary of subset name, NMFRecommender of its stored factors, like the models
+                from create_model.df_to_latent_features
+        '''
+        return {name: self.get_model(name) for name in self.names}
+
+    def get_ratings(self, name):
+        '''
+        Input: Subset name
+        Output: DataFrame of athlete ratings, DataFrame of segment ratings, one rating_* column per
+                latent feature
+        '''
+        return self.get_model(name).get_ratings()
+
+    def get_scorer(self, name, **kwargs):
+        '''
+        Input: Subset name, Keyword arguments for FactorScorer
+        Output: FactorScorer of the subset's memory-mapped factors
+        '''
+        arrays = self.arrays[name]
+        return FactorScorer(arrays['athlete_factors'], arrays['segment_factors'],
+                            arrays['athlete_ids'], arrays['segment_ids'],
+                            arrays.get('segment_means'), arrays.get('segment_stds'), **kwargs)
@@ -0,0 +1,373 @@
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Keeps multiplicative updates from dividing by zero
+epsilon = 1e-10
+
+def get_pair_means(sums, counts):
+    '''
+    Input: Sparse csr or csc matrix of each pair's target sum, matrix of the same format of its
+           count, built from the same pairs
+    Output: Sparse matrix of the same format of each pair's average target
+    '''
+    # Both totals are built from the same pairs, so they share one sparsity structure
+    return type(sums)((sums.data / counts.data, sums.indices, sums.indptr), shape=sums.shape)
+
+class SparseNMF(object):
+    '''
+    Non-negative matrix factorization fit only to the observed (stored) entries of a sparse matrix,
+    the missing entries are unknown rather than zero
+    '''
+    def __init__(self, num_factors=1, solver='mu', regularization=0, max_iterations=100,
+                 tol=1e-4, random_state=None):
+        '''
+        Input: Number of latent features, Solver to use, 'mu' (multiplicative updates) or 'hals'
+               (hierarchical alternating least squares), L2 regularization on the factors,
+               Maximum number of iterations, Relative improvement in training RMSE to stop at,
+               Seed for the random initial factors
+        '''
+        if solver not in ('mu', 'hals'):
+            raise ValueError("solver must be 'mu' or 'hals', got {}".format(solver))
+        self.num_factors = num_factors
+        self.solver = solver
+        self.regularization = regularization
+        self.max_iterations = max_iterations
+        self.tol = tol
+        self.random_state = random_state
+
+    def fit(self, matrix, row_factors=None, column_factors=None):
+        '''
+        Input: Sparse matrix of observations, Optional initial row and column factors to warm start
+               from, arrays of shape (rows, num_factors) and (columns, num_factors)
+        Output: self, with row_factors, column_factors, rmse_history and iterations set
+        '''
+        matrix = sp.csr_matrix(matrix, dtype=np.float64)
+        matrix.sum_duplicates()
+        self.row_factors, self.column_factors = self.initial_factors(matrix, row_factors,
+                                                                     column_factors)
+        return self.run_updates(matrix, None, None, self.max_iterations)
+
+    def partial_fit(self, matrix, rows, columns, max_iterations=None):
+        '''
+        Input: Sparse matrix of observations, possibly with more rows and columns than the fitted
+               factors, Arrays of the row and column indices to update, Maximum number of
+               iterations, defaults to max_iterations
+        Output: self
+
+        Warm starts from the fitted factors and only updates the given rows and columns, all other
+        factors are held fixed. New rows and columns are appended with the initial factor scale
+        and folded in by the updates, so they must be among the rows and columns passed
+        '''
+        matrix = sp.csr_matrix(matrix, dtype=np.float64)
+        matrix.sum_duplicates()
+
+        # Grow the factors to fit any new rows or columns, starting them at the initial scale
+        scale = np.sqrt(matrix.data.mean() / self.num_factors) if matrix.nnz else 1.
+        num_new_rows = matrix.shape[0] - self.row_factors.shape[0]
+        num_new_columns = matrix.shape[1] - self.column_factors.shape[0]
+        self.row_factors = np.vstack([self.row_factors, 
+                                      np.ones((num_new_rows, self.num_factors)) * scale])
+        self.column_factors = np.vstack([self.column_factors, 
+                                         np.ones((num_new_columns, self.num_factors)) * scale])
+
+        iterations = self.max_iterations if max_iterations is None else max_iterations
+        return self.run_updates(matrix, np.asarray(rows), np.asarray(columns), iterations)
+
+    def run_updates(self, matrix, rows, columns, max_iterations):
+        '''
+        Input: Sparse csr matrix of observations, Arrays of the row and column indices to update,
+               None to update all of them, Maximum number of iterations
+        Output: self, with rmse_history and iterations set
+
+        Alternates updating row and column factors until the RMSE over the observations in the
+        updated rows stops improving by a relative tol
+        '''
+        matrix_t = matrix.T.tocsr()
+        scored = matrix if rows is None else matrix[rows]
+
+        def rmse():
+            row_factors = self.row_factors if rows is None else self.row_factors[rows]
+            return self.observed_rmse(scored, row_factors, self.column_factors)
+
+        self.rmse_history = [rmse()]
+        self.iterations = 0
+        t = time.time()
+        while self.iterations < max_iterations:
+            self.update_factors(matrix, self.row_factors, self.column_factors, rows)
+            self.update_factors(matrix_t, self.column_factors, self.row_factors, columns)
+            self.iterations += 1
+            self.rmse_history.append(rmse())
+
+            # Stop once an iteration no longer improves the fit by a relative tol
+            previous, current = self.rmse_history[-2:]
+            if previous - current <= self.tol * previous:
+                break
+        self.fit_time = time.time() - t
+        return self
+
+    def initial_factors(self, matrix, row_factors, column_factors):
+        '''
+        Input: Sparse matrix of observations, Optional initial row and column factors
+        Output: Row factors, column factors
+
+        Missing factors are drawn uniformly and scaled so initial predictions are near the mean
+        observation
+        '''
+        random = np.random.RandomState(self.random_state)
+        scale = np.sqrt(matrix.data.mean() / self.num_factors) if matrix.nnz else 1.
+        if row_factors is None:
+            row_factors = random.uniform(.5, 1.5, (matrix.shape[0], self.num_factors)) * scale
+        if column_factors is None:
+            column_factors = random.uniform(.5, 1.5, (matrix.shape[1], self.num_factors)) * scale
+        return (np.array(row_factors, dtype=np.float64),
+                np.array(column_factors, dtype=np.float64))
+
+    def observed_predictions(self, rows, columns):
+        '''
+        Input: Arrays of row and column indices
+        Output: Array of the factorization's predictions at those entries
+        '''
+        return np.einsum('ij,ij->i', self.row_factors[rows], self.column_factors[columns])
+
+    def observed_rmse(self, matrix, row_factors, column_factors):
+        '''
+        Input: Sparse csr matrix of observations, its rows' factors, its columns' factors
+        Output: Root mean squared error of the factorization over the observed entries
+        '''
+        if not matrix.nnz:
+            return 0.
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        predictions = np.einsum('ij,ij->i', row_factors[rows], column_factors[matrix.indices])
+        return np.sqrt(((matrix.data - predictions) ** 2).mean())
+
+    def update_factors(self, matrix, factors, other_factors, rows=None):
+        '''
+        Input: Sparse csr matrix of observations, factors for its rows (updated in place), factors
+               for its columns (held fixed), Array of the rows to update, None for all of them
+        Output: None
+
+        Called with the transposed matrix and the factors swapped to update column factors
+        '''
+        if rows is not None:
+            matrix = matrix[rows]
+        row_factors = factors if rows is None else factors[rows]
+
+        # Local row and column of every observation, in the matrix's storage order
+        observed_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        observed_columns = matrix.indices
+
+        def observed_matrix(data):
+            return sp.csr_matrix((data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+        predictions = np.einsum('ij,ij->i', row_factors[observed_rows], 
+                                other_factors[observed_columns])
+
+        if self.solver == 'mu':
+            # Multiplicative update, weighted to the observed entries
+            row_factors *= matrix.dot(other_factors) / (
+                           observed_matrix(predictions).dot(other_factors) +
+                           self.regularization * row_factors + epsilon)
+        else:
+            # Hierarchical alternating least squares, each factor column in turn is set to its 
+            # non-negative least squares solution over the observed entries given all the others
+            residuals = matrix.data - predictions
+            ones = observed_matrix(np.ones(matrix.nnz))
+            for factor in range(self.num_factors):
+                row_factor = row_factors[:, factor]
+                other_factor = other_factors[:, factor]
+
+                # Residuals with this factor's contribution added back in
+                residuals += row_factor[observed_rows] * other_factor[observed_columns]
+                row_factor[:] = np.maximum(observed_matrix(residuals).dot(other_factor) /
+                                           (ones.dot(other_factor ** 2) +
+                                            self.regularization + epsilon), 0)
+                residuals -= row_factor[observed_rows] * other_factor[observed_columns]
+
+        if rows is not None:
+            factors[rows] = row_factors
+
+class NMFRecommender(object):
+    '''
+    Fits a SparseNMF to a DataFrame of aggregated athlete-segment pairs, standing in for GraphLab's
+    factorization_recommender
+    '''
+    def __init__(self, user_id='athlete_id', item_id='segment_id', target='average_speed',
+                 count='effort_count', user_code='athlete_code', item_code='segment_code', 
+                 **nmf_params):
+        '''
+        Input: Name of the user column, name of the item column, name of the target column,
+               Name of the optional column with how many efforts each pair's target averages,
+               Names of the optional columns of dense integer user and item codes,
+               Keyword arguments for SparseNMF
+        '''
+        self.user_id = user_id
+        self.item_id = item_id
+        self.target = target
+        self.count = count
+        self.user_code = user_code
+        self.item_code = item_code
+        self.nmf = SparseNMF(**nmf_params)
+        self.pair_sums = self.pair_counts = None
+
+    def fit(self, agg_df, user_factors=None, item_factors=None):
+        '''
+        Input: DataFrame with one row per user-item pair and its target value, Optional initial
+               user and item factors to warm start from, in the order the pairs give the users
+               and items codes
+        Output: self
+
+        With code columns, users and items are found by indexing lookup arrays of the model's row
+        for each code rather than by hashing their ids
+        '''
+        if self.user_code in agg_df and self.item_code in agg_df:
+            no_users = pd.Index(agg_df[self.user_id].values[:0])
+            no_items = pd.Index(agg_df[self.item_id].values[:0])
+            empty_lookup = np.empty(0, dtype=np.int32)
+            self.users, self.user_lookup = self.append_ids(agg_df, self.user_id, self.user_code,
+                                                           no_users, empty_lookup)
+            self.items, self.item_lookup = self.append_ids(agg_df, self.item_id, self.item_code,
+                                                           no_items, empty_lookup)
+            user_codes, item_codes = self.get_codes(agg_df)
+        else:
+            user_codes, users = pd.factorize(agg_df[self.user_id])
+            item_codes, items = pd.factorize(agg_df[self.item_id])
+            self.users, self.items = pd.Index(users), pd.Index(items)
+            self.user_lookup = self.item_lookup = None
+
+        # Keep each pair's target sum and count so later efforts can update the averages exactly
+        counts = agg_df[self.count].values if self.count in agg_df else np.ones(len(agg_df))
+        self.set_pair_totals(user_codes, item_codes, agg_df[self.target].values * counts, counts)
+
+        self.nmf.fit(self.pair_means(), user_factors, item_factors)
+        return self
+
+    def update(self, delta_df, max_iterations=None):
+        '''
+        Input: DataFrame of new efforts (or pre-aggregated pairs with a count column) with user,
+               item and target columns, Maximum number of warm started iterations
+        Output: self
+
+        Folds the new efforts into each pair's average and refits only the users and items the
+        new efforts touch, starting from the current factors. Users and items the model has not
+        seen are appended after the existing ones, so existing codes never change
+        '''
+        if self.pair_sums is None:
+            raise ValueError('Model has no pair totals to update, it was not fit here (e.g. it '
+                             'was loaded from a model artifact), refit it on the efforts instead')
+        if not len(delta_df):
+            return self
+
+        # Aggregate the new efforts to target sums and counts per pair, keeping their codes
+        counts = delta_df[self.count] if self.count in delta_df else 1
+        delta_df = delta_df.assign(target_sum=delta_df[self.target] * counts, 
+                                   target_count=counts)
+        keys = [self.user_id, self.item_id] + [code for code in [self.user_code, self.item_code]
+                                               if code in delta_df]
+        delta = delta_df.groupby(keys)[['target_sum', 'target_count']].sum().reset_index()
+
+        # Append unseen users and items, then code every pair
+        self.users, self.user_lookup = self.append_ids(delta, self.user_id, self.user_code,
+                                                       self.users, self.user_lookup)
+        self.items, self.item_lookup = self.append_ids(delta, self.item_id, self.item_code,
+                                                       self.items, self.item_lookup)
+        user_codes, item_codes = self.get_codes(delta)
+
+        # Add the new totals to the existing pairs' totals
+        totals = self.pair_sums.tocoo(), self.pair_counts.tocoo()
+        self.set_pair_totals(np.concatenate([totals[0].row, user_codes]),
+                             np.concatenate([totals[0].col, item_codes]),
+                             np.concatenate([totals[0].data, delta.target_sum.values]),
+                             np.concatenate([totals[1].data, delta.target_count.values]))
+
+        self.nmf.partial_fit(self.pair_means(), np.unique(user_codes), np.unique(item_codes),
+                             max_iterations)
+        return self
+
+    def append_ids(self, df, id_column, code_column, ids, lookup):
+        '''
+        Input: DataFrame of pairs, name of its id column, name of its code column, Index of the
+               model's ids, Array of the model's row for each code (None without codes)
+        Output: Index of the ids with the unseen ones appended, Lookup array covering them
+
+        Without a code column the model stops using codes and looks ids up in the Index instead
+        '''
+        if lookup is None or code_column not in df:
+            new_ids = pd.Index(df[id_column].unique()).difference(ids)
+            return ids.append(new_ids), None
+
+        # Grow the lookup to the largest code, then give new codes the next rows in code order
+        codes = df[code_column].values
+        size = max(len(lookup), codes.max() + 1 if len(codes) else 0)
+        lookup = np.concatenate([lookup, np.full(size - len(lookup), -1, dtype=np.int32)])
+        new = lookup[codes] < 0
+        new_codes = np.unique(codes[new])
+        lookup[new_codes] = len(ids) + np.arange(len(new_codes))
+
+        new_ids = np.empty(len(new_codes), dtype=df[id_column].dtype)
+        new_ids[lookup[codes[new]] - len(ids)] = df[id_column].values[new]
+        return ids.append(pd.Index(new_ids)), lookup
+
+    def get_codes(self, df):
+        '''
+        Input: DataFrame of user-item pairs
+        Output: Array of the model's user row for each pair, array of its item column, -1 for
+                users or items the model never saw
+        '''
+        def lookup_codes(id_column, code_column, ids, lookup):
+            if lookup is None or code_column not in df:
+                return ids.get_indexer(df[id_column])
+            codes = df[code_column].values
+            rows = np.full(len(codes), -1, dtype=np.int32)
+            known = (codes >= 0) & (codes < len(lookup))
+            rows[known] = lookup[codes[known]]
+            return rows
+
+        return (lookup_codes(self.user_id, self.user_code, self.users, self.user_lookup),
+                lookup_codes(self.item_id, self.item_code, self.items, self.item_lookup))
+
+    def set_pair_totals(self, user_codes, item_codes, sums, counts):
+        '''
+        Input: Arrays of user codes, item codes, target sums and effort counts, one per pair
+               (repeated pairs are added together)
+        Output: None
+        '''
+        shape = (len(self.users), len(self.items))
+        self.pair_sums = sp.csr_matrix((sums, (user_codes, item_codes)), shape=shape)
+        self.pair_counts = sp.csr_matrix((counts, (user_codes, item_codes)), shape=shape)
+        self.pair_sums.sum_duplicates()
+        self.pair_counts.sum_duplicates()
+
+    def pair_means(self):
+        '''
+        Output: Sparse csr matrix of each pair's average target
+        '''
+        return get_pair_means(self.pair_sums, self.pair_counts)
+
+    def predict(self, df):
+        '''
+        Input: DataFrame of user-item pairs
+        Output: Array of predicted targets, NaN for users or items the model never saw
+        '''
+        user_codes, item_codes = self.get_codes(df)
+        known = (user_codes >= 0) & (item_codes >= 0)
+
+        predictions = np.empty(len(df))
+        predictions.fill(np.nan)
+        predictions[known] = self.nmf.observed_predictions(user_codes[known], item_codes[known])
+        return predictions
+
+    def get_ratings(self):
+        '''
+        Output: DataFrame of user ratings, DataFrame of item ratings, one rating_* column per
+                latent feature
+        '''
+        columns = ['rating_{}'.format(i+1) for i in range(self.nmf.num_factors)]
+        user_ratings = pd.DataFrame(self.nmf.row_factors,
+                                    index=pd.Index(self.users, name=self.user_id),
+                                    columns=columns)
+        item_ratings = pd.DataFrame(self.nmf.column_factors,
+                                    index=pd.Index(self.items, name=self.item_id),
+                                    columns=columns)
+        return user_ratings, item_ratings
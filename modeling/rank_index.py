@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from file_io import atomic_write
+
+def top_k_indices(values, k):
+    '''
+    Input:  Array of values, number of top values wanted, -1 for all of them
+    Output: Array of the indices of the k largest values, largest first
+
+    Partially selects the top k before sorting, so only those k values are ever sorted
+    '''
+    if k < -1:
+        raise ValueError('k must be -1 or at least 0, got {}'.format(k))
+    if k == 0:
+        return np.array([], dtype=np.intp)
+    if k == -1 or k >= len(values):
+        return np.argsort(values)[::-1]
+    top_k = np.argpartition(values, len(values) - k)[-k:]
+    return top_k[np.argsort(values[top_k])[::-1]]
+
+class RankIndex(object):
+    '''
+    Full ranking of one rating column, answers rank, percentile and neighbour queries for any 
+    athlete/segment by binary search rather than scanning or re-sorting the ratings
+    '''
+    def __init__(self, ids, ratings, average_speeds=None):
+        '''
+        Input:  Array of athlete/segment ids, array of their ratings, Optional array of their
+                average speeds, all ordered best first
+        '''
+        self.ids = np.asarray(ids)
+        self.ratings = np.asarray(ratings)
+        self.average_speeds = None if average_speeds is None else np.asarray(average_speeds)
+
+        # Ids sorted, with each one's position in the ranking, for binary search lookups
+        id_order = np.argsort(self.ids, kind='mergesort')
+        self.sorted_ids = self.ids[id_order]
+        self.id_positions = id_order
+
+    @classmethod
+    def from_series(cls, ratings, average_speeds=None):
+        '''
+        Input:  Series of ratings indexed by athlete/segment id, higher is better, Optional Series
+                of average speeds indexed by athlete/segment id
+        Output: RankIndex of the series
+        '''
+        order = top_k_indices(ratings.values, -1)
+        ids = ratings.index.values[order]
+        if average_speeds is not None:
+            average_speeds = average_speeds.reindex(ids).values
+        return cls(ids, ratings.values[order], average_speeds)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Input:  Path of a RankIndex stored with save
+        Output: RankIndex
+        '''
+        arrays = np.load(path)
+        index = cls.__new__(cls)
+        for name in ['ids', 'ratings', 'sorted_ids', 'id_positions']:
+            setattr(index, name, arrays[name])
+        index.average_speeds = arrays['average_speeds'] if 'average_speeds' in arrays.files \
+                               else None
+        return index
+
+    def save(self, path):
+        '''
+        Input:  Path to store the RankIndex at, an .npz file
+        Output: None
+        '''
+        arrays = {'ids': self.ids, 'ratings': self.ratings, 
+                  'sorted_ids': self.sorted_ids, 'id_positions': self.id_positions}
+        if self.average_speeds is not None:
+            arrays['average_speeds'] = self.average_speeds
+
+        # Written atomically, so the app never loads half an index
+        with atomic_write(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def position(self, entity_id):
+        '''
+        Input:  Athlete/segment id
+        Output: Its zero based position in the ranking, None if it is not ranked
+        '''
+        i = np.searchsorted(self.sorted_ids, entity_id)
+        if i == len(self.sorted_ids) or self.sorted_ids[i] != entity_id:
+            return None
+        return int(self.id_positions[i])
+
+    def rank(self, entity_id):
+        '''
+        Input:  Athlete/segment id
+        Output: Tuple of its rank (1 is best), its percentile (percent of ranked athletes/segments 
+                at or below it) and its rating, None if it is not ranked
+        '''
+        position = self.position(entity_id)
+        if position is None:
+            return None
+        num_ranked = len(self.ids)
+        return (position + 1, 
+                100. * (num_ranked - position) / num_ranked, 
+                float(self.ratings[position]))
+
+    def around(self, entity_id, width=5):
+        '''
+        Input:  Athlete/segment id, number of neighbours wanted on each side
+        Output: DataFrame of rank, id and rating for the athletes/segments ranked around it, None 
+                if it is not ranked
+        '''
+        position = self.position(entity_id)
+        if position is None:
+            return None
+        return self.slice(max(position - width, 0), position + width + 1)
+
+    def top(self, k):
+        '''
+        Input:  Number of leaders wanted
+        Output: DataFrame of rank, id and rating for the top k
+        '''
+        return self.slice(0, k)
+
+    def slice(self, start, stop):
+        '''
+        Input:  Zero based start and stop positions in the ranking
+        Output: DataFrame of rank, id, rating and average_speed (when the index has them) for
+                those positions
+        '''
+        slice_df = pd.DataFrame({'rank': np.arange(start + 1, 
+                                                   start + 1 + len(self.ids[start:stop])),
+                                 'id': self.ids[start:stop],
+                                 'rating': self.ratings[start:stop]}, 
+                                columns=['rank', 'id', 'rating'])
+        if self.average_speeds is not None:
+            slice_df['average_speed'] = self.average_speeds[start:stop]
+        return slice_df
@@ -1,13 +1,134 @@
+import os
+import json
 import numpy as np
 import pandas as pd
 import create_model as cm
+from effort_matrix import EffortMatrix
+from rank_index import top_k_indices, RankIndex
+from file_io import atomic_write
+
+# Directory the app serves boards from, and the manifest written once a store's files are in place
+app_data = '../app/app_data/'
+board_manifest = 'boards_manifest.json'
+
+# Extensions of the files the manifest vouches for
+board_extensions = ('.csv', '.npz')
+
+def write_board_manifest(app_data=app_data):
+    '''
+    Input:  Directory the boards are stored in
+    Output: None
+
+    Records the name, size and modification time of every board file after the last one is
+    renamed into place. The app only loads boards that match it, never a store still in progress
+    '''
+    boards = []
+    for name in sorted(os.listdir(app_data)):
+        if name.endswith(board_extensions):
+            stat = os.stat(os.path.join(app_data, name))
+            boards.append([name, stat.st_size, stat.st_mtime])
+
+    with atomic_write(os.path.join(app_data, board_manifest)) as f:
+        json.dump({'boards': boards}, f)
 
 class Leaderboards(object):
-    def __init__(self, speeds):
+    def __init__(self, speeds, clip_percentile=None):
         '''
-        Input:  Dataframe of segment_id, athlete_id, average speed, and seg_average_grade
+        Input:  Dataframe of segment_id, athlete_id, average speed, and seg_average_grade, or an
+                EffortMatrix of them, Percentile of each rating column to scale to 0 and 100 from
+                both ends (e.g. 1 scales the 1st - 99th percentiles to 0 - 100, ratings beyond
+                them fall outside it but keep their order), None to scale by the full range
         '''
         self.speeds = speeds
+        self.clip_percentile = clip_percentile
+
+        # Per athlete/segment speed statistics, built once per board type by get_speed_stats
+        self.speed_stats = {}
+
+    def get_speed_stats(self, board_type):
+        '''
+        Input:  Type of board
+        Output: DataFrame indexed by athlete/segment id of its average_speed and effort_count over
+                all efforts, and {subset}_average_speed and {subset}_effort_count for each subset 
+                in subset_querys_dict
+
+        The table is built once per board type and shared by scaling, orientation and the 
+        leaderboard merge
+        '''
+        if board_type in self.speed_stats:
+            return self.speed_stats[board_type]
+
+        # Subsets by name, '' for all of the efforts
+        querys = [('', None)] + [('{}_'.format(name), query) 
+                                 for name, query in sorted(cm.subset_querys_dict.items())]
+        if isinstance(self.speeds, EffortMatrix):
+            ids, totals = self.get_matrix_totals(board_type, querys)
+        else:
+            ids, totals = self.get_df_totals(board_type, querys)
+
+        stats = {}
+        for prefix, sums, counts in totals:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats[prefix + 'average_speed'] = sums / counts
+            stats[prefix + 'effort_count'] = counts
+
+        # Codes of athletes/segments without efforts here, the id dictionary spans every load
+        present = stats['effort_count'] > 0
+        index = pd.Index(ids[present], name='{}_id'.format(board_type))
+        self.speed_stats[board_type] = pd.DataFrame({name: values[present] 
+                                                     for name, values in stats.items()}, 
+                                                    index=index, columns=sorted(stats))
+        return self.speed_stats[board_type]
+
+    def get_df_totals(self, board_type, querys):
+        '''
+        Input:  Type of board, list of (prefix, query string or None) subsets
+        Output: Array of ids, list of (prefix, array of summed speeds, array of effort counts)
+
+        Every subset is aggregated with bincounts over one set of id codes, the speeds' own
+        {board_type}_code column when it has one
+        '''
+        codes, ids = self.get_codes(board_type)
+        speeds = self.speeds.average_speed.values.astype(np.float64)
+
+        totals = []
+        for prefix, query in querys:
+            mask = self.speeds.eval(query).values if query else None
+            subset_codes = codes if mask is None else codes[mask]
+            subset_speeds = speeds if mask is None else speeds[mask]
+            totals.append((prefix, 
+                           np.bincount(subset_codes, weights=subset_speeds, minlength=len(ids)),
+                           np.bincount(subset_codes, minlength=len(ids))))
+        return ids, totals
+
+    def get_matrix_totals(self, board_type, querys):
+        '''
+        Input:  Type of board, list of (prefix, query string or None) subsets
+        Output: Array of ids, list of (prefix, array of summed speeds, array of effort counts)
+
+        Sums the EffortMatrix's pair totals over each subset's view rather than the efforts
+        '''
+        totals = []
+        for prefix, query in querys:
+            ids, sums, counts = self.speeds.get_totals(board_type, query)
+            totals.append((prefix, sums, counts))
+        return ids, totals
+
+    def get_codes(self, board_type):
+        '''
+        Input:  Type of board
+        Output: Array of each effort's athlete/segment code, array of the id for each code
+        '''
+        ids = self.speeds['{}_id'.format(board_type)].values
+        code_column = '{}_code'.format(board_type)
+        if code_column not in self.speeds:
+            return pd.factorize(ids)
+
+        # Dense codes index straight into an array of their ids
+        codes = self.speeds[code_column].values
+        code_ids = np.zeros(codes.max() + 1 if len(codes) else 0, dtype=ids.dtype)
+        code_ids[codes] = ids
+        return codes, code_ids
 
     def store(self, board_type, ratings_df, board_size=20):
         '''
@@ -18,7 +139,13 @@ class Leaderboards(object):
         '''
         leaderboards = self.get(board_type, ratings_df, board_size)
         for key in leaderboards.keys():
-            leaderboards[key].to_csv('../app/app_data/{}_{}_leaderboard.csv'.format(board_type, key))
+            # Written atomically, so the app's board watcher never reads a half written csv
+            file_name = os.path.join(app_data, '{}_{}_leaderboard.csv'.format(board_type, key))
+            with atomic_write(file_name) as f:
+                leaderboards[key].to_csv(f)
+
+        # Only now are the boards consistent, the watcher waits for the manifest to match them
+        write_board_manifest(app_data)
 
     def get(self, board_type, ratings_df, board_size=20):
         '''
@@ -26,33 +153,89 @@ class Leaderboards(object):
         Output: List of DataFrames with the top n_leaders ratings and their rank 
                 for each latent feature
         '''
-        # Store the Dataframe of ratings and requested leaderboard size
-        self.board_type = board_type
-        self.board_direction = -1 if board_type == 'athlete' else 1
-        self.ratings = ratings_df
+        # Store the requested leaderboard size
         self.board_size = -1 if board_size == 'all' else board_size
 
         # Make scaled ratings df
-        self.scaled_ratings = ratings_df.copy(deep=True)
-        for column in self.ratings.columns:
-            self.scale_column_ratings(column)
+        self.scale_ratings(board_type, ratings_df)
 
         # Make leaderboard dict
         leaderboards = {column: self.get_n_leaders(column) for column in self.ratings.columns}
 
         return leaderboards
 
+    def scale_ratings(self, board_type, ratings_df):
+        '''
+        Input:  Type of board, DataFrame of ratings
+        Output: None
+
+        Stores the board type, its direction, the ratings and their 0 - 100 scaled copy. Every 
+        column is scaled at once in a single float32 copy of the ratings, missing ratings stay NaN
+        '''
+        self.board_type = board_type
+        self.board_direction = -1 if board_type == 'athlete' else 1
+        self.ratings = ratings_df
+
+        # The one copy of the ratings that gets scaled in place
+        scaled = ratings_df.values.astype(np.float32)
+
+        # Make sure that the ratings are correctly oriented, columnwise
+        orientations = np.array([self.get_orientation(ratings_df[column], column) 
+                                 for column in ratings_df.columns], dtype=np.float32)
+        scaled *= self.board_direction * orientations
+
+        # Robust scaling maps the clip percentiles rather than the extremes to 0 and 100,
+        # columnwise. Ratings beyond them are not clipped, they land outside 0 - 100 but keep
+        # their order
+        if self.clip_percentile:
+            low, high = np.nanpercentile(scaled, [self.clip_percentile, 
+                                                  100 - self.clip_percentile], axis=0)
+        else:
+            low, high = np.nanmin(scaled, axis=0), np.nanmax(scaled, axis=0)
+
+        # Subtract the low end from all, columnwise
+        scaled -= low.astype(np.float32)
+
+        # Multiply by the ratio of 100:(high - low), columnwise
+        scaled *= (100. / (high - low)).astype(np.float32)
+
+        self.scaled_ratings = pd.DataFrame(scaled, index=ratings_df.index, 
+                                           columns=ratings_df.columns)
+
+    def get_rank_indexes(self, board_type, ratings_df):
+        '''
+        Input:  Type of board, DataFrame of ratings
+        Output: Dictionary of rating column, RankIndex of every rated athlete/segment and their
+                average speeds
+        '''
+        self.scale_ratings(board_type, ratings_df)
+        average_speeds = self.get_speed_stats(board_type).average_speed
+        return {column: RankIndex.from_series(self.scaled_ratings[column].dropna(), 
+                                              average_speeds) 
+                for column in self.ratings.columns}
+
+    def store_rank_indexes(self, board_type, ratings_df):
+        '''
+        Input:  Type of board, DataFrame of ratings
+        Output: None
+
+        Store the full ranking of each rating column in app_data, next to the leaderboard csvs,
+        where the app answers rank lookups for athletes/segments off the boards from them
+        '''
+        rank_indexes = self.get_rank_indexes(board_type, ratings_df)
+        for column, rank_index in rank_indexes.items():
+            rank_index.save(os.path.join(app_data, 
+                                         '{}_{}_rank_index.npz'.format(board_type, column)))
+        write_board_manifest(app_data)
+
     def get_n_leaders(self, rating_column):
         '''
         Input:  Column from user latent feature (rating) matrix
         Output: DataFrame of top n leaders and their ratings for input column
         '''
-        # Get the indicies of the sorted scaled ratings
+        # Get the indicies of the top n scaled ratings, best first
         good_ratings = self.scaled_ratings[rating_column].dropna()
-        sorted_scaled_ratings_indices = np.argsort(good_ratings.values)
-
-        # We only want the top n leaders for the leaderboard
-        top_n_indices = sorted_scaled_ratings_indices[-1:-self.board_size-1:-1]
+        top_n_indices = top_k_indices(good_ratings.values, self.board_size)
         
         # Grab the top n leaders and their rating_column stats
         n_leaders = good_ratings.iloc[top_n_indices]
@@ -60,13 +243,13 @@ class Leaderboards(object):
         
         # Get those leaders average speeds
         group = '{}_id'.format(self.board_type)
-        avg_speeds = self.speeds.groupby(group).average_speed.mean().reset_index()
+        avg_speeds = self.get_speed_stats(self.board_type).average_speed.reset_index()
 
         # Join average speeds with leaderboard
         n_leaders_df = pd.merge(n_leaders_df, avg_speeds, on=group, how='left')
 
         # Make new column, rank, ranging from 1 - n
-        worst_rank = n_leaders_df.shape[0] if self.board_size == -1 else self.board_size
+        worst_rank = n_leaders_df.shape[0]
         n_leaders_df['rank'] = range(1, worst_rank+1)
 
         # Set it to be the index
@@ -74,51 +257,18 @@ class Leaderboards(object):
 
         return n_leaders_df
 
-    def scale_column_ratings(self, rating_column):
-        '''
-        Input:  DataFrame of latent features (ratings)
-        Output: Copy of ratings 
-
-        Scales ratings from current to 0 - 100, by column
-        '''
-        # Athletes in column
-        athletes = self.scaled_ratings[pd.notnull(self.scaled_ratings[rating_column])].index
-
-        # Make np array of those athletes columns ratings
-        scaled_ratings_column = self.scaled_ratings.ix[athletes][rating_column]
-    
-        # Figure out the orentation of ratings scale
-        orientation = self.get_orientation(scaled_ratings_column, rating_column)
-
-        # Make sure that the ratings are correctly oriented
-        scaled_ratings_column *= self.board_direction * orientation
-
-        # Add the magnitude of the minimum rating to all, columnwise
-        scaled_ratings_column -= scaled_ratings_column.min()
-
-        # Multiply by the ratio of 100:(new max rating), columnwise
-        scaled_ratings_column *= 100. / scaled_ratings_column.max() 
-
-        # Set the newly scaled column values back into the scaled df
-        self.scaled_ratings[rating_column] = scaled_ratings_column.dropna()
-
     def get_orientation(self, scaled_ratings_column, rating_column):
         '''
-        Input: Ratings column pandas series, name of column to check orientation
+        Input: Ratings column pandas series (unscaled), name of column to check orientation
         Output: 1 or -1 depending on how a rating scale is oriented
         '''
         # Get correct name from rating_column to index into subset_querys_dict with
         dict_name = rating_column[:-7]
 
-        # Get corresponding query
-        subset_query = cm.subset_querys_dict[dict_name]
-
-        # Subset scaled_ratings_column
-        avg_speed_subset = self.speeds.query(subset_query) if subset_query else self.speeds
-
-        # Group avg_speed_subset by board_type
-        type_mean_speed = avg_speed_subset.groupby('{}_id'.format(self.board_type)) \
-                                                  .average_speed.mean()
+        # Get the board_type's mean speeds over the corresponding subset, dropping those with no
+        # efforts in it
+        speed_stats = self.get_speed_stats(self.board_type)
+        type_mean_speed = speed_stats['{}_average_speed'.format(dict_name)].dropna()
 
         # "Best" board_type by rating in scaled_ratings_column
         best = scaled_ratings_column.idxmax()
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import itertools
+import numpy as np
+import pandas as pd
+import create_model as cm
+import validate_model as vm
+from nmf import NMFRecommender
+from effort_matrix import EffortMatrix
+from file_io import atomic_write
+from fork_pool import fork_map, shared
+
+def get_configs(param_grid):
+    '''
+    Input: Dictionary of SparseNMF setting name, list of values to try, e.g. num_factors,
+           regularization, max_iterations and solver
+    Output: List of dictionaries of settings, one for every combination of the values
+    '''
+    names = sorted(param_grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[param_grid[name] for name in names])]
+
+def get_rung_iterations(max_iterations, rung, rungs, eta):
+    '''
+    Input: Configuration's max_iterations, rung number, number of rungs, halving rate
+    Output: Total number of iterations the configuration is fit for by the end of the rung
+
+    The last rung runs the full max_iterations, each rung before it 1/eta as many
+    '''
+    return int(np.ceil(max_iterations / float(eta ** (rungs - 1 - rung))))
+
+def get_validation_split(training_df, validation_fraction):
+    '''
+    Input: DataFrame of training efforts, Fraction of them, the latest, to hold out
+    Output: DataFrame of efforts to fit on, DataFrame of validation efforts
+
+    Split on date like validate_model.split_efforts, so configurations are chosen on later
+    efforts of the athletes they were fit on without ever looking at the testing efforts
+    '''
+    dates = training_df.date.sort_values()
+    cutoff = dates.iloc[min(int(len(dates) * (1 - validation_fraction)), len(dates) - 1)]
+    return vm.split_efforts(training_df, cutoff)
+
+def run_config(args):
+    '''
+    Input: Tuple of config number, dictionary of SparseNMF settings, Dictionary of subset name,
+           most iterations to run, Dictionary of subset name, (athlete factors, segment factors)
+           to continue from, None to start new models, True to also score on the testing subsets
+    Output: Tuple of config number, Dictionary of subset name, (athlete factors, segment
+            factors), Dictionary of subset name, iterations actually run, DataFrame of the models'
+            validation error metrics by subset, DataFrame of their testing error metrics or None,
+            seconds spent fitting
+
+    Worker for sweeps, fits on the shared training aggregates and scores on the shared
+    validation and testing aggregates inherited from the parent. Only the factors go back to the
+    parent, the pair totals each model builds are rebuilt from the shared aggregates when it
+    continues
+    '''
+    number, params, iterations, factors, score_test = args
+
+    # Configurations from an earlier rung warm start from their factors rather than starting over
+    t = time.time()
+    models = {name: NMFRecommender(**dict(params, max_iterations=iterations[name]))
+                    .fit(agg, *(factors or {}).get(name, (None, None)))
+              for name, agg in shared['train_aggs'].items()}
+    fit_time = time.time() - t
+
+    metrics = vm.evaluate_aggs(models, shared['validation_aggs'])[0]
+    test_metrics = vm.evaluate_aggs(models, shared['test_aggs'])[0] if score_test else None
+    factors = {name: (model.nmf.row_factors, model.nmf.column_factors)
+               for name, model in models.items()}
+    # Models stop early once an iteration no longer improves their fit by tol
+    iterations = {name: model.nmf.iterations for name, model in models.items()}
+    return number, factors, iterations, metrics, test_metrics, fit_time
+
+def save_results(results, results_path):
+    '''
+    Input: DataFrame of sweep results, path of the csv to write
+    Output: None
+    '''
+    directory = os.path.dirname(results_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with atomic_write(results_path) as f:
+        results.to_csv(f, index=False)
+
+def sweep(training_df, testing_df, param_grid, segment_type_names=['total', 'uphill', 'downhill'],
+          rungs=3, eta=2, n_jobs=-1, results_path='../data/sweep_results.csv', random_state=0,
+          validation_fraction=.2):
+    '''
+    Input: DataFrame of training efforts, DataFrame of testing efforts (e.g. from
+           validate_model.split_efforts) or None, Dictionary of SparseNMF setting name, list of
+           values to try, list of subset types, Number of successive halving rungs, Fraction of
+           the configurations (1/eta) kept after each rung, Number of configurations to fit at the
+           same time, -1 for one per cpu, Path to write the results csv to, None to not write it,
+           Seed for every model's initial factors, unless the grid sets random_state, Fraction of
+           the training efforts, the latest, held out to choose configurations on
+    Output: DataFrame of every configuration's settings, validation RMSE by subset and their
+            mean, testing RMSE of the configurations that reached the last rung, most iterations
+            any subset's model actually ran, last rung reached and seconds spent fitting, sorted
+            by validation RMSE then fit time
+
+    Successive halving: every configuration is fit for 1/eta**(rungs-1) of its max_iterations,
+    then only the best 1/eta by mean validation RMSE continue to the next rung's budget, so weak
+    configurations stop early and only the strongest run their full max_iterations. The testing
+    efforts are only scored for reporting, they never decide which configurations continue
+    '''
+    configs = [dict({'random_state': random_state}, **config) for config in get_configs(param_grid)]
+
+    # Aggregate the efforts once, every configuration reads the same subsets
+    fit_df, validation_df = get_validation_split(training_df, validation_fraction)
+    aggs = {'train_aggs': cm.get_agg_dfs_for_model(fit_df, segment_type_names),
+            'validation_aggs': cm.get_matrix_aggs_for_model(EffortMatrix(validation_df),
+                                                            segment_type_names),
+            'test_aggs': None}
+    if testing_df is not None:
+        aggs['test_aggs'] = cm.get_matrix_aggs_for_model(EffortMatrix(testing_df),
+                                                         segment_type_names)
+
+    factors = {number: None for number in range(len(configs))}
+    iterations = {number: {name: 0 for name in segment_type_names} 
+                  for number in range(len(configs))}
+    rows = {}
+    for rung in range(rungs):
+        tasks = []
+        score_test = testing_df is not None and rung == rungs - 1
+        for number in sorted(factors):
+            budget = get_rung_iterations(configs[number].get('max_iterations', 100), rung,
+                                         rungs, eta)
+            tasks.append((number, configs[number], 
+                          {name: budget - ran for name, ran in iterations[number].items()},
+                          factors[number], score_test))
+        results = fork_map(run_config, tasks, aggs, n_jobs)
+
+        # Record every configuration's latest scores, iterations and fit time add up across rungs
+        for number, config_factors, ran, metrics, test_metrics, fit_time in results:
+            factors[number] = config_factors
+            for name in ran:
+                iterations[number][name] += ran[name]
+            row = dict(configs[number])
+            row.update({'{}_rmse'.format(name): rmse for name, rmse in metrics.rmse.items()})
+            row.update({'rmse': metrics.rmse.values.mean(), 
+                        'iterations': max(iterations[number].values()),
+                        'rung': rung, 'stopped_early': rung < rungs - 1,
+                        'fit_time': rows.get(number, {}).get('fit_time', 0) + fit_time})
+            if test_metrics is not None:
+                row.update({'test_{}_rmse'.format(name): rmse
+                            for name, rmse in test_metrics.rmse.items()})
+                row['test_rmse'] = test_metrics.rmse.values.mean()
+            rows[number] = row
+
+        # Keep the best 1/eta, configurations without a score rank last
+        if rung < rungs - 1:
+            scores = sorted((np.inf if np.isnan(rows[number]['rmse']) else
+                             rows[number]['rmse'], number) for number in factors)
+            keep = [number for score, number in scores[:max(1, len(scores) // eta)]]
+            factors = {number: factors[number] for number in keep}
+
+    columns = sorted(set(param_grid) | {'random_state'})
+    columns += ['{}_rmse'.format(name) for name in segment_type_names] + ['rmse']
+    if testing_df is not None:
+        columns += ['test_{}_rmse'.format(name) for name in segment_type_names] + ['test_rmse']
+    columns += ['iterations', 'rung', 'stopped_early', 'fit_time']
+    results = pd.DataFrame([rows[number] for number in sorted(rows)], columns=columns)
+    results = results.sort_values(['rmse', 'fit_time']).reset_index(drop=True)
+
+    if results_path:
+        save_results(results, results_path)
+    return results
+
+if __name__ == '__main__':
+    sys.path.append('../eda')
+    from strava_db import EffortDfGetter
+
+    df = EffortDfGetter(origin='json', cache=True).get()
+    training_df, testing_df = vm.split_efforts(df)
+    param_grid = {'num_factors': [1, 2, 4, 8],
+                  'regularization': [0, .01, .1],
+                  'max_iterations': [100, 400],
+                  'solver': ['mu', 'hals']}
+    print sweep(training_df, testing_df, param_grid).head(10)
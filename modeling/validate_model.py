@@ -1,8 +1,10 @@
+import time
 import random
 import numpy as np
 import pandas as pd
-import graphlab as gl
 import create_model as cm
+from effort_matrix import EffortMatrix
+from fork_pool import fork_map, shared
 
 def plot_ratings(ratings_df):
     '''
@@ -67,28 +69,191 @@ def split_efforts(df, date='2015-08-01'):
 
     return training_df, testing_df
 
+def get_backtest_folds(df, num_folds=5, min_train_fraction=.5):
+    '''
+    Input:  Full effort DataFrame, number of folds, fraction of the efforts the first fold trains on
+    Output: List of (cutoff date, array of training positions, array of testing positions)
+
+    Expanding window splits: each fold trains on every effort up to its cutoff and tests on the
+    efforts until the next cutoff, for athletes with efforts before the cutoff like split_efforts.
+    The dates are sorted once and every fold is a pair of slices of that order
+    '''
+    order = np.argsort(df.date.values, kind='mergesort')
+    sorted_dates = df.date.values[order]
+    athlete_codes = df.athlete_code.values if 'athlete_code' in df else \
+                    pd.factorize(df.athlete_id)[0]
+
+    # Cutoffs evenly spaced through the efforts after the first fold's training efforts
+    positions = np.linspace(min_train_fraction, 1, num_folds + 1)[:-1] * len(order)
+    cutoffs = sorted_dates[np.maximum(positions.astype(np.int64) - 1, 0)]
+
+    # Efforts on a cutoff date are training efforts, as date <= cutoff in split_efforts
+    bounds = list(np.searchsorted(sorted_dates, cutoffs, side='right')) + [len(order)]
+
+    folds = []
+    for cutoff, train_end, test_end in zip(cutoffs, bounds[:-1], bounds[1:]):
+        train, test = order[:train_end], order[train_end:test_end]
+
+        # Only test on athletes who have efforts before the cutoff
+        in_train = np.zeros(athlete_codes.max() + 1, dtype=bool)
+        in_train[athlete_codes[train]] = True
+        folds.append((pd.Timestamp(cutoff), train, test[in_train[athlete_codes[test]]]))
+    return folds
+
+def fit_fold(args):
+    '''
+    Input:  Tuple of fold number, number of latent features, dictionary of SparseNMF settings
+    Output: Tuple of fold number, DataFrame of the fold's error metrics by subset
+
+    Worker for backtests, slices the shared effort DataFrame inherited from the parent with the
+    fold's positions
+    '''
+    fold, number_latent_features, nmf_params = args
+    df = shared['df']
+    cutoff, train, test = shared['folds'][fold]
+
+    t = time.time()
+    athlete_ratings, segment_ratings, models = cm.df_to_latent_features(df.iloc[train],
+                                                                        number_latent_features,
+                                                                        **nmf_params)
+    fit_time = time.time() - t
+
+    metrics, segment_errors, timings = evaluate_models(models, df.iloc[test])
+    return fold, metrics.assign(fold=fold, cutoff=cutoff, fit_time=fit_time)
+
+def backtest(df, num_folds=5, min_train_fraction=.5, number_latent_features=1, n_jobs=-1,
+             **nmf_params):
+    '''
+    Input:  Full effort DataFrame, number of folds, fraction of the efforts the first fold trains
+            on, Number of latent features for the models, Number of folds to fit at the same time,
+            -1 for one per cpu, SparseNMF settings for the models
+    Output: DataFrame of every fold's error metrics by subset, DataFrame of their mean and std
+            across folds by subset
+
+    Fits every fold of get_backtest_folds in a process pool, so many folds take about as long as
+    one fold per cpu
+    '''
+    folds = get_backtest_folds(df, num_folds, min_train_fraction)
+    tasks = [(fold, number_latent_features, nmf_params) for fold in range(len(folds))]
+    results = fork_map(fit_fold, tasks, {'df': df, 'folds': folds}, n_jobs)
+
+    fold_metrics = pd.concat([metrics for fold, metrics in sorted(results)])
+    fold_metrics.index.name = 'subset'
+    summary = fold_metrics.groupby(level='subset')[['rmse', 'mae', 'coverage', 'fit_time']] \
+                          .agg(['mean', 'std'])
+    return fold_metrics, summary
+
+def get_mongo_split_aggs(df_getter, segment_type_names, date='2015-08-01'):
+    '''
+    Input: EffortDfGetter reading from mongo, list of subset types, date to split on
+    Output: Dictionary of aggregated training dfs, Dictionary of aggregated testing dfs
+
+    Same split as split_efforts, aggregated over athlete-segment pairs in the database
+    '''
+    # The total training subset is needed for the athletes with efforts before date
+    training_aggs = cm.get_mongo_agg_dfs_for_model(df_getter, set(segment_type_names) | {'total'},
+                                                   end_date=date)
+    testing_aggs = cm.get_mongo_agg_dfs_for_model(df_getter, segment_type_names, start_date=date)
+
+    # Only test on athletes who have efforts before date
+    athletes_in_train = training_aggs['total'].athlete_id.unique()
+    testing_aggs = {name: agg[agg.athlete_id.isin(athletes_in_train)].reset_index(drop=True)
+                    for name, agg in testing_aggs.items()}
+
+    return {name: training_aggs[name] for name in segment_type_names}, testing_aggs
+
 def testing_rmse(models, testing_df):
     '''
-    Input: Dictionary of trained GraphLab recommender models, Test observation DataFrame
+    Input: Dictionary of trained recommender models, Test observation DataFrame
     Output: Dictionary of RMSEs for testing_df and subsets
 
     Get the root mean squared error for the test data's predicted values from the models for the
     total testing df and the respective subsets.
     '''
-    # Get all subset dfs from testing df
-    dfs_for_test = cm.get_dfs_for_model(testing_df, models.keys())
+    metrics, segment_errors, timings = evaluate_models(models, testing_df)
+    return metrics.rmse.to_dict()
+
+def testing_agg_rmse(models, aggs_for_test):
+    '''
+    Input: Dictionary of trained recommender models, Dictionary of subset name, test data 
+           aggregated over athlete-segment pairs
+    Output: Dictionary of RMSEs for the subsets
+    '''
+    metrics, segment_errors, timings = evaluate_aggs(models, aggs_for_test)
+    return metrics.rmse.to_dict()
+
+def evaluate_models(models, testing_df):
+    '''
+    Input: Dictionary of trained recommender models, Test observation DataFrame
+    Output: DataFrame of error metrics by subset, Dictionary of subset name, DataFrame of errors
+            by segment pairs, Dictionary of seconds spent in each stage
+
+    Aggregates the test efforts once into an EffortMatrix that every subset model is scored from
+    '''
+    t = time.time()
+    aggs_for_test = cm.get_matrix_aggs_for_model(EffortMatrix(testing_df), models.keys())
+    aggregate_time = time.time() - t
+
+    metrics, segment_errors, timings = evaluate_aggs(models, aggs_for_test)
+    timings['aggregate'] = aggregate_time
+    return metrics, segment_errors, timings
+
+def evaluate_aggs(models, aggs_for_test):
+    '''
+    Input: Dictionary of trained recommender models, Dictionary of subset name, test data 
+           aggregated over athlete-segment pairs
+    Output: DataFrame of error metrics by subset, Dictionary of subset name, DataFrame of errors
+            by segment pairs, Dictionary of seconds spent in each stage
+
+    Pairs the models never saw an athlete or segment of can not be predicted, they are left out
+    of the errors and counted in coverage
+    '''
+    # Predict on each aggregated testing subset with its model, joined to the pairs by code
+    t = time.time()
+    predictions = {name: cm.predict_agg(models[name], agg) for name, agg in aggs_for_test.items()}
+    predict_time = time.time() - t
+
+    t = time.time()
+    metrics, segment_errors = {}, {}
+    for name, agg in aggs_for_test.items():
+        metrics[name], segment_errors[name] = get_errors(agg, predictions[name])
+    metrics = pd.DataFrame.from_dict(metrics, orient='index')[['rmse', 'mae', 'pairs', 
+                                                               'coverage']]
+
+    return metrics, segment_errors, {'predict': predict_time, 'metrics': time.time() - t}
 
-    # Get all subset sfs from testing df
-    sfs_for_test = cm.get_sfs_for_model(testing_df, models.keys())
+def get_errors(agg_df, predictions):
+    '''
+    Input: DataFrame of aggregated test pairs, Array of their predicted average speeds, NaN where
+           the model can not predict
+    Output: Dictionary of rmse, mae, number of pairs and coverage, DataFrame indexed by segment_id
+            of each segment's rmse, mae and number of predicted pairs
+    '''
+    predicted = ~np.isnan(predictions)
+    errors = predictions[predicted] - agg_df.average_speed.values[predicted]
 
-    # Predict on testing data SFrame with model
-    predictions = {name: np.array(models[name].predict(sf)) for name, sf in 
-                   sfs_for_test.items()}
+    # Segment of every predicted pair, by its dense code when the pairs have codes
+    segment_ids = agg_df.segment_id.values[predicted]
+    if 'segment_code' in agg_df:
+        segment_codes = agg_df.segment_code.values[predicted]
+        code_ids = np.zeros(segment_codes.max() + 1 if len(segment_codes) else 0, 
+                            dtype=segment_ids.dtype)
+        code_ids[segment_codes] = segment_ids
+    else:
+        segment_codes, code_ids = pd.factorize(segment_ids)
 
-    # Calculate root mean squared error between actual test data and predicted values from model
-    def rmse(df, prediction):
-        agg_df = df.groupby(['athlete_id', 'segment_id']).mean().average_speed
-        return (((agg_df.values - prediction) ** 2) ** 0.5).mean()
+    counts = np.bincount(segment_codes, minlength=len(code_ids))
+    squared = np.bincount(segment_codes, weights=errors ** 2, minlength=len(code_ids))
+    absolute = np.bincount(segment_codes, weights=np.abs(errors), minlength=len(code_ids))
+    present = counts > 0
+    segment_errors = pd.DataFrame({'rmse': np.sqrt(squared[present] / counts[present]),
+                                   'mae': absolute[present] / counts[present],
+                                   'pairs': counts[present]},
+                                  index=pd.Index(code_ids[present], name='segment_id'),
+                                  columns=['rmse', 'mae', 'pairs'])
 
-    rmses = {name: rmse(df, predictions[name]) for name, df in dfs_for_test.items()}
-    return rmses
+    metrics = {'rmse': np.sqrt((errors ** 2).mean()) if len(errors) else np.nan,
+               'mae': np.abs(errors).mean() if len(errors) else np.nan,
+               'pairs': len(errors),
+               'coverage': predicted.mean() if len(predicted) else np.nan}
+    return metrics, segment_errors